@@ -5,6 +5,8 @@
 /* setup methdods table */
 static PyMethodDef cWarpImageMehods [] = {
 	{ "warp_image", warp_image, METH_VARARGS },
+	{ "set_num_threads", py_set_num_threads, METH_VARARGS },
+	{ "get_num_threads", py_get_num_threads, METH_VARARGS },
 	{ NULL, NULL}
 };
 
@@ -78,3 +80,15 @@ static PyObject * warp_image (PyObject *self, PyObject *args){
 	Py_XDECREF(Center);
 	return PyArray_Return (PyOut);
 }
+
+static PyObject * py_set_num_threads (PyObject *self, PyObject *args){
+	int nthreads;
+	if (!PyArg_ParseTuple(args, "i", &nthreads))
+		return NULL;
+	set_num_threads(nthreads);
+	Py_RETURN_NONE;
+}
+
+static PyObject * py_get_num_threads (PyObject *self, PyObject *args){
+	return Py_BuildValue("i", get_num_threads());
+}
@@ -2,17 +2,41 @@
 #include <iostream>
 #include <cmath>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+/* pixel value with edge clamping */
+inline double pixel_at(double *img, int nrow, int ncol, int ir, int ic){
+	if (ir < 0) ir = 0;
+	if (ir > nrow - 1) ir = nrow - 1;
+	if (ic < 0) ic = 0;
+	if (ic > ncol - 1) ic = ncol - 1;
+	return img[ir * ncol + ic];
+}
+
+/* cubic convolution kernel weights (Keys, a = -0.5) for fractional offset t */
+inline void cubic_weights(double t, double *w){
+	const double a = -0.5;
+	double t2 = t * t;
+	double t3 = t2 * t;
+	w[0] = a * (t3 - 2. * t2 + t);
+	w[1] = (a + 2.) * t3 - (a + 3.) * t2 + 1.;
+	w[2] = -(a + 2.) * t3 + (2. * a + 3.) * t2 - a * t;
+	w[3] = -a * (t3 - t2);
+}
+
 bool remap(int nrow, int ncol, double *img, int nqp, int nqz, 
 		double *qp, double *qz, double *pixel, double *cen,
 		double alphai, double k0, double sdd, int method, 
 		double *out){
 
-    for (int i = 0; i < 2; i++)
-        cen[i] /= pixel[i];
+	double cen_px[2];
+	for (int i = 0; i < 2; i++)
+		cen_px[i] = cen[i] / pixel[i];
 	double sin_ai = std::sin(alphai);
 	double cos_ai = std::cos(alphai);
-	int ir, ic;
-#pragma omp parallel for private(ir, ic)
+#pragma omp parallel for schedule(static)
 	for (int i = 0; i < nqp * nqz; i++){
 		double sina = (qz[i] / k0) - sin_ai;
 		double cosa = sincos(sina);
@@ -28,8 +52,9 @@ bool remap(int nrow, int ncol, double *img, int nqp, int nqz,
 		double cost = t1 / t2;
 		double tant = sgn(qp[i]) * sincos(cost) / cost;
 		
-		double row = tana * sdd / cost / pixel[1] + cen[1];
-		double col = tant * sdd / pixel[0] + cen[0];
+		double row = tana * sdd / cost / pixel[1] + cen_px[1];
+		double col = tant * sdd / pixel[0] + cen_px[0];
+		int ir, ic;
 		switch(method){
 			case NEAREST_NEIGHBOR:
 				ir = (int) (row + 0.5);
@@ -40,13 +65,64 @@ bool remap(int nrow, int ncol, double *img, int nqp, int nqz,
 					out[i] = 0.;
 				break;
 
-
 			case BILINEAR:
+				if (!(row >= 0. && row <= nrow - 1 && col >= 0. && col <= ncol - 1)){
+					out[i] = 0.;
+					break;
+				}
+				{
+					ir = (int) row;
+					ic = (int) col;
+					double fr = row - ir;
+					double fc = col - ic;
+					double top = (1. - fc) * pixel_at(img, nrow, ncol, ir, ic) +
+						fc * pixel_at(img, nrow, ncol, ir, ic + 1);
+					double bottom = (1. - fc) * pixel_at(img, nrow, ncol, ir + 1, ic) +
+						fc * pixel_at(img, nrow, ncol, ir + 1, ic + 1);
+					out[i] = (1. - fr) * top + fr * bottom;
+				}
 				break;
 
 			case CUBIC_SPLINE:
+				if (!(row >= 0. && row <= nrow - 1 && col >= 0. && col <= ncol - 1)){
+					out[i] = 0.;
+					break;
+				}
+				{
+					ir = (int) row;
+					ic = (int) col;
+					double wr[4], wc[4];
+					cubic_weights(row - ir, wr);
+					cubic_weights(col - ic, wc);
+					double value = 0.;
+					for (int m = 0; m < 4; m++){
+						double line = 0.;
+						for (int n = 0; n < 4; n++)
+							line += wc[n] * pixel_at(img, nrow, ncol, ir + m - 1, ic + n - 1);
+						value += wr[m] * line;
+					}
+					out[i] = value;
+				}
 				break;
+
+			default:
+				out[i] = 0.;
 		}
 	}
 	return true;
 }
+
+void set_num_threads(int nthreads){
+#ifdef _OPENMP
+	if (nthreads > 0)
+		omp_set_num_threads(nthreads);
+#endif
+}
+
+int get_num_threads(){
+#ifdef _OPENMP
+	return omp_get_max_threads();
+#else
+	return 1;
+#endif
+}
@@ -37,4 +37,8 @@ bool remap(
 		double *OUT_IMAGE
 		);
 
+/* OpenMP thread count used by remap; no-ops when built without OpenMP */
+void set_num_threads(int NTHREADS);
+int get_num_threads();
+
 #endif // REMESH__H
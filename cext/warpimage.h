@@ -8,6 +8,8 @@
 /* setup methdods */
 PyMODINIT_FUNC initcWarpImage();
 static PyObject * warp_image (PyObject *, PyObject *);
+static PyObject * py_set_num_threads (PyObject *, PyObject *);
+static PyObject * py_get_num_threads (PyObject *, PyObject *);
 
 /* utility functions */
 float ** pymatrix_to_Carrayptrs (PyArrayObject *);
@@ -274,7 +274,9 @@ def gaussianresidual(params, x, data, sig=1):
 
 
 def findgisaxsarcs(img, cen, experiment):
-    radialprofile = integration.pixel_2Dintegrate(img, (cen[1], cen[0]), experiment.mask)
+    # one joint (r, chi) pass over the image; every ring's chi profile is a slice of it
+    rchi = integration.rchi_2Dintegrate(img, (cen[1], cen[0]), experiment.mask)
+    radialprofile = np.nan_to_num(rchi.radialprofile())
     # arcs = scanforarcs(radialprofile, cen)
     arcs = peakfinding.findpeaks(None, radialprofile, (100, 50), gaussianwidthsigma=3, minimumsigma=100)
     # print arcs
@@ -287,7 +289,7 @@ def findgisaxsarcs(img, cen, experiment):
     _, unique = np.unique(arcs, return_index=True)
 
     for qmu in arcs[unique]:
-        chiprofile = np.nan_to_num(integration.chi_2Dintegrate(img, (cen[1], cen[0]), qmu, mask=experiment.mask))
+        chiprofile = np.nan_to_num(rchi.chiprofile(qmu))
 
         plt.plot(np.arange(0, np.pi, 1 / 30.), chiprofile, 'r')
 
@@ -1,12 +1,14 @@
 import os
 import sys
 import inspect
+import threading
 import h5py
 import tifffile
 import glob
 import numpy as np
 from fabio.fabioimage import fabioimage
 from fabio import fabioutils, edfimage
+from fabio.TiffIO import TiffIO
 import fabio
 import pyFAI
 from pyFAI import detectors
@@ -28,12 +30,226 @@ def register_fabioclass(cls):
     return cls
 
 
+# EDF DataType -> numpy type
+edfdtypes = {'UnsignedByte': 'u1', 'SignedByte': 'i1', 'UnsignedShort': 'u2', 'SignedShort': 'i2',
+             'UnsignedInteger': 'u4', 'SignedInteger': 'i4', 'UnsignedLong': 'u4', 'SignedLong': 'i4',
+             'Unsigned64': 'u8', 'Signed64': 'i8', 'FloatValue': 'f4', 'Float': 'f4', 'DoubleValue': 'f8',
+             'Double': 'f8'}
+
+
+def _readedfblock(f, offset=0):
+    # Parse the EDF header block starting at offset; returns the header and the offset of the frame data
+    f.seek(offset)
+    block = ''
+    while '}' not in block:
+        chunk = f.read(512)  # EDF headers are padded to multiples of 512 bytes
+        if not chunk or len(block) > 2 ** 20:
+            return None, None
+        block += chunk
+    if '{' not in block:
+        return None, None
+
+    end = block.index('}')
+    header = OrderedDict()
+    for line in block[block.index('{') + 1:end].split(';'):
+        if '=' in line:
+            key, value = line.split('=', 1)
+            header[key.strip()] = value.strip()
+
+    end += 1
+    if block[end:end + 2] == '\r\n':
+        end += 2
+    elif block[end:end + 1] == '\n':
+        end += 1
+    return header, offset + end
+
+
+def readedfheader(path):
+    """
+    Header of the first frame of an EDF file (merged with its 7.3.3 .txt sidecar, as EdfImage), read without decoding
+    the pixel data
+    """
+    with open(path, 'rb') as f:
+        header, _ = _readedfblock(f)
+    if header is None:
+        raise IOError('No EDF header found in ' + path)
+    header.update(EdfImage.scanparas(path.replace('.edf', '.txt')))
+    return header
+
+
+# Files smaller than this are read into memory rather than mapped: a map holds a file descriptor for as long as any of
+# its frames lives (eg. in the frame cache), so a long series of small frames would run out of descriptors
+memmapminbytes = 16 * 2 ** 20
+
+
+def _mapworthy(path):
+    return os.path.getsize(path) >= memmapminbytes
+
+
+def readtiffheader(path):
+    """
+    Header of the first page of a TIFF file, as fabio reports it, read from its tags without decoding the pixel data
+    """
+    with open(path, 'rb') as f:
+        return TiffIO(f).getInfo(0)
+
+
+def mapedf(path):
+    """
+    Frames of an uncompressed EDF file as views of a single copy-on-write memory map of the file (read into memory if
+    the file is smaller than memmapminbytes)
+    :return: list of (header, frame); None if any frame is compressed or not a 2D image
+    """
+    frames = []
+    size = os.path.getsize(path)
+    offset = 0
+    buffer = np.memmap(path, dtype=np.uint8, mode='c') if size >= memmapminbytes else None
+    with open(path, 'rb') as f:
+        while offset < size:
+            header, dataoffset = _readedfblock(f, offset)
+            if header is None:
+                break
+            if header.get('Compression', 'None') not in ['None', 'NoCompression'] or 'Dim_3' in header \
+                    or header.get('DataType') not in edfdtypes:
+                return None
+            dtype = np.dtype(edfdtypes[header['DataType']])
+            dtype = dtype.newbyteorder('<' if header.get('ByteOrder', 'LowByteFirst') == 'LowByteFirst' else '>')
+            shape = int(header['Dim_2']), int(header['Dim_1'])
+            nbytes = int(header.get('Size', shape[0] * shape[1] * dtype.itemsize))
+            if dataoffset + nbytes > size:
+                return None
+            npixels = shape[0] * shape[1]
+            if buffer is not None:
+                frame = buffer[dataoffset:dataoffset + npixels * dtype.itemsize].view(dtype).reshape(shape)
+            else:
+                f.seek(dataoffset)
+                frame = np.fromfile(f, dtype=dtype, count=npixels).reshape(shape)
+            frames.append((header, frame))
+            offset = dataoffset + nbytes
+    return frames or None
+
+
+def _rawframeshape(npixels):
+    # Frame shape of a headerless int32 detector file: a single frame of a known detector if one matches, otherwise
+    # the first detector whose frame size divides the file into whole frames
+    shapes = []
+    for name, detector in detectors.ALL_DETECTORS.iteritems():
+        if getattr(detector, 'MAX_SHAPE', None) is None:
+            continue
+        shapes.append(tuple(detector.MAX_SHAPE))
+        for binning in getattr(detector, 'BINNED_PIXEL_SIZE', {}).keys():
+            shapes.append(tuple(int(n) for n in np.array(detector.MAX_SHAPE) / binning))
+    for shape in shapes:
+        if np.prod(shape) == npixels:
+            return shape
+    for shape in shapes:
+        if npixels % np.prod(shape) == 0:
+            return shape
+    return None
+
+
+def mapraw(path, dtype=np.int32):
+    """
+    A headerless raw detector file as a copy-on-write memory-mapped (frames, rows, cols) array, read into memory if
+    smaller than memmapminbytes; None if no detector shape fits
+    """
+    npixels = os.path.getsize(path) // np.dtype(dtype).itemsize
+    shape = _rawframeshape(npixels)
+    if shape is None:
+        return None
+    shape = (npixels // int(np.prod(shape)),) + shape
+    if not _mapworthy(path):
+        return np.fromfile(path, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return np.memmap(path, dtype=dtype, mode='c', shape=shape)
+
+
+def maptiff(path, mapped=None):
+    """
+    The first series of a TIFF file, as a copy-on-write memory map when its pixels are stored uncompressed and
+    contiguously (and the file is at least memmapminbytes, unless mapped is given), read by tifffile otherwise
+    :return: (array, number of pages)
+    """
+    if mapped is None:
+        mapped = _mapworthy(path)
+    with tifffile.TiffFile(path) as tif:
+        npages = len(tif.pages)
+        series = tif.series[0]
+        offset = getattr(series, 'offset', None)  # None unless the series data is contiguous and uncompressed
+        if mapped and offset is not None:
+            dtype = np.dtype(tif.byteorder + series.dtype.char)
+            return np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=series.shape), npages
+        return tif.asarray(), npages
+
+
+def memmapframes(path):
+    """
+    Frames of an uncompressed npy, raw, EDF or TIFF file as memory-mapped views, so that pixels are only read from disk
+    when they are accessed. Views are copy-on-write, never modifying the file. Files smaller than memmapminbytes are
+    read into memory instead.
+    :return: (frames, rows, cols) array or list of 2D arrays; None if the file can't be mapped
+    """
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == '.npy':
+            data = np.load(path, mmap_mode='c' if _mapworthy(path) else None)
+        elif ext == '.raw':
+            data = mapraw(path)
+        elif ext == '.edf':
+            frames = mapedf(path)
+            return None if frames is None else [frame for _, frame in frames]
+        elif ext in ['.tif', '.tiff']:
+            data, npages = maptiff(path)
+            if data.ndim == 3 and len(data) != npages:
+                return None  # samples per pixel (eg. RGB), not frames
+        else:
+            return None
+    except Exception as ex:  # fabio gets to read anything these readers can't
+        msg.logMessage(('Could not memory-map', path, str(ex)), msg.DEBUG)
+        return None
+
+    if data is None or data.ndim not in (2, 3):
+        return None
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    return data
+
+
 @register_fabioclass
 class EdfImage(edfimage.EdfImage):
     extensions = ['.edf']
 
     def read(self, f, frame=None):
-        return super(EdfImage, self).read(f, frame)
+        # Uncompressed files are memory-mapped; anything else is left to fabio
+        frames = mapedf(f) if isinstance(f, basestring) else None
+        if frames is None:
+            return super(EdfImage, self).read(f, frame)
+
+        self._mappedframes = frames
+        self.filename = f
+        self.currentframe = frame or 0
+        header, self.data = frames[self.currentframe]
+        self.header = OrderedDict(header)
+        self.header.update(self.scanparas(f.replace('.edf', '.txt')))
+        return self
+
+    def getframe(self, num):
+        frames = getattr(self, '_mappedframes', None)
+        if frames is None:
+            return super(EdfImage, self).getframe(num)
+        header, data = frames[num]
+        return EdfImage(data=data, header=OrderedDict(header))
+
+    @property
+    def nframes(self):
+        # Mapped files keep their own frame list; fabio's reader keeps one in _frames
+        frames = getattr(self, '_mappedframes', None)
+        if frames is None:
+            frames = getattr(self, '_frames', None)
+        return 1 if frames is None else len(frames)
+
+    @nframes.setter
+    def nframes(self, n):
+        pass
 
     def _readheader(self, f):
         super(EdfImage, self)._readheader(f)
@@ -90,9 +306,27 @@ class npyimage(fabioimage):
     extensions = ['.npy']
 
     def read(self, f, frame=None):
-        self.data = np.load(f)
+        # Memory-mapped unless small; 3D arrays are read as a stack of frames
+        self.volume = np.load(f, mmap_mode='c' if _mapworthy(f) else None)
+        if self.volume.ndim == 2:
+            self.volume = self.volume[np.newaxis]
+        self.data = self.volume[frame or 0]
         return self
 
+    def __len__(self):
+        return len(self.volume)
+
+    @property
+    def nframes(self):
+        return len(self.volume) if getattr(self, 'volume', None) is not None else 1
+
+    @nframes.setter
+    def nframes(self, n):
+        pass
+
+    def getframe(self, frame=0):
+        return npyimage(data=self.volume[frame], header=self.header)
+
 
 @register_fabioclass
 class hipgisaxsimage(fabioimage):
@@ -135,26 +369,185 @@ class rawimage(fabioimage):
     extensions = ['raw']
 
     def read(self, f, frame=None):
-        with open(f, 'r') as f:
-            data = np.fromfile(f, dtype=np.int32)
-        for name, detector in detectors.ALL_DETECTORS.iteritems():
-            if hasattr(detector, 'MAX_SHAPE'):
-                # print name, detector.MAX_SHAPE, imgdata.shape[::-1]
-                if np.prod(detector.MAX_SHAPE) == len(data):  #
-                    detector = detector()
-                    msg.logMessage('Detector found: ' + name, msg.INFO)
-                    break
-            if hasattr(detector, 'BINNED_PIXEL_SIZE'):
-                # print detector.BINNED_PIXEL_SIZE.keys()
-                if len(data) in [np.prod(np.array(detector.MAX_SHAPE) / b) for b in
-                                 detector.BINNED_PIXEL_SIZE.keys()]:
-                    detector = detector()
-                    msg.logMessage('Detector found with binning: ' + name, msg.INFO)
-                    break
-        data.shape = detector.MAX_SHAPE
-        self.data = data
+        # Memory-mapped; files holding several detector frames are read as a stack
+        self.volume = mapraw(f)
+        if self.volume is None:
+            raise IOError('No detector shape matches the size of ' + f)
+        msg.logMessage('Raw frame shape: ' + str(self.volume.shape[1:]), msg.INFO)
+        self.data = self.volume[frame or 0]
         return self
 
+    def __len__(self):
+        return len(self.volume)
+
+    @property
+    def nframes(self):
+        return len(self.volume) if getattr(self, 'volume', None) is not None else 1
+
+    @nframes.setter
+    def nframes(self, n):
+        pass
+
+    def getframe(self, frame=0):
+        return rawimage(data=self.volume[frame], header=self.header)
+
+
+# Shared read-only HDF5 handles, reference counted per file, and per-file layout metadata
+_h5handles = dict()
+_h5layouts = dict()
+_h5lock = threading.RLock()
+
+
+def openh5(path):
+    """
+    Shared read-only h5py handle of a file. Every call must be paired with a closeh5(path); the file is closed when the
+    last reference is released.
+    """
+    path = os.path.abspath(path)
+    with _h5lock:
+        entry = _h5handles.get(path)
+        if entry is None or not entry[0]:  # missing or closed elsewhere
+            entry = _h5handles[path] = [h5py.File(path, 'r'), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def closeh5(path):
+    path = os.path.abspath(path)
+    with _h5lock:
+        entry = _h5handles.get(path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _h5handles[path]
+            if entry[0]:
+                entry[0].close()
+
+
+def h5layout(path, scan):
+    """
+    Layout metadata of an HDF5 file (dataset paths, frame lists, flags), computed once by scan(h5file) and cached until
+    the file is modified
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path), scan.__name__)
+    with _h5lock:
+        if key not in _h5layouts:
+            h = openh5(path)
+            try:
+                _h5layouts[key] = scan(h)
+            finally:
+                closeh5(path)
+        return _h5layouts[key]
+
+
+# Reader class of each file seen, keyed by absolute path and validated by size and mtime
+_formatcache = dict()
+_formatlock = threading.Lock()
+h5magic = b"\x89HDF\r\n\x1a\n"
+
+
+def _filekey(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), (stat.st_size, stat.st_mtime)
+
+
+def cachedformat(path):
+    """
+    Reader class previously found for a file, if the file hasn't changed since; otherwise None
+    """
+    path, stamp = _filekey(path)
+    with _formatlock:
+        entry = _formatcache.get(path)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    return None
+
+
+def rememberformat(path, image_class):
+    path, stamp = _filekey(path)
+    with _formatlock:
+        _formatcache[path] = (stamp, image_class)
+
+
+def ish5(path):
+    with open(path, 'rb') as f:
+        return f.read(len(h5magic)) == h5magic
+
+
+def h5signature(path):
+    """
+    H5 image class identified from the top-level attributes of an HDF5 file, without trying every reader; None if
+    the attributes don't identify one
+    """
+    h = openh5(path)
+    try:
+        facility, end_station = h.attrs.get('facility'), h.attrs.get('end_station')
+    finally:
+        closeh5(path)
+    if facility == 'als' and end_station == 'bl733':
+        return ALS733H5image
+    if facility == 'als' and end_station == 'bl832':
+        return ALS832H5image
+    return None
+
+
+def openimage(path, frame=None):
+    """
+    fabio.open through the format dispatch cache: once a file's reader class is known (from its signature or a first
+    fabio.open), it is instantiated directly until the file changes
+    """
+    image_class = cachedformat(path)
+    if image_class is None and ish5(path):
+        image_class = h5signature(path)
+    if image_class is not None:
+        obj = image_class()
+        obj.read(path, frame)
+    else:
+        obj = fabio.open(path, frame)
+    rememberformat(path, obj.__class__)
+    return obj
+
+
+_h5imageclasses = None
+
+
+def h5imageclasses():
+    """
+    H5 image classes of this module in the order H5image.read tries them; DXchangeH5image goes last, as it breaks on
+    files that don't match it
+    """
+    global _h5imageclasses
+    if _h5imageclasses is None:
+        classes = [image for name, image in inspect.getmembers(sys.modules[__name__], inspect.isclass)
+                   if 'H5image' in name and name != 'H5image']
+        classes.sort(key=lambda image: image.__name__ == 'DXchangeH5image')
+        _h5imageclasses = classes
+    return _h5imageclasses
+
+
+def stackselection(item, shape):
+    """
+    (start, stop, step) along each axis of a (frames, rows, cols) stack selected by an index item of ints and slices
+    """
+    if not isinstance(item, tuple) and not isinstance(item, list):
+        item = (item,)
+    s = []
+    for n, size in enumerate(shape):
+        index = item[n] if n < len(item) else slice(None)
+        if isinstance(index, slice):
+            s.append(index.indices(size))
+        else:
+            index = int(index)
+            if index < 0:
+                index += size
+            s.append((index, index + 1, 1))
+    return s
+
+
+def selectionshape(s):
+    return tuple(len(xrange(*axis)) for axis in s)
+
 
 @register_fabioclass
 class H5image(fabioimage):
@@ -187,30 +580,35 @@ class H5image(fabioimage):
     extensions = ['h5']
 
     def read(self, filename, frame=None):
-        h5image_classes = [image for image in inspect.getmembers(sys.modules[__name__], inspect.isclass)
-                           if 'H5image' in image[0] and image[0] != 'H5image']
-
-        # this block ensures that the Dxchange class is the last one checked, as it breaks the following loop if
-        # the image does not match this class
-        for image_class in h5image_classes:
-            if 'DXchangeH5image' in str(image_class):
-                dxchange_class = image_class
-        h5image_classes.remove(dxchange_class)
-        h5image_classes.append(dxchange_class)
-
-        for image_class in h5image_classes:
-            try:
-                obj = image_class[1](self.data, self.header)
-                obj.read(filename)
-            except H5ReadError:
-                # Skip exception and try the next H5 image class
-                continue
+        # Hold a handle for the duration of the trials so that each class reuses the same open file
+        openh5(filename)
+        try:
+            # Try the reader known for this file first
+            known = cachedformat(filename) or h5signature(filename)
+            classes = h5imageclasses()
+            if known in classes:
+                classes = [known] + [image_class for image_class in classes if image_class is not known]
+
+            for image_class in classes:
+                obj = image_class(self.data, self.header)
+                try:
+                    obj.read(filename)
+                except H5ReadError:
+                    # Release the handle of the failed trial and try the next H5 image class
+                    obj.close()
+                    continue
+                except Exception:
+                    obj.close()
+                    raise
+                else:
+                    # If not error was thrown break out of loop
+                    break
             else:
-                # If not error was thrown break out of loop
-                break
-        else:
-            # If for loop finished without breaking raise ReadError
-            raise H5ReadError('H5 format not recognized')
+                # If for loop finished without breaking raise ReadError
+                raise H5ReadError('H5 format not recognized')
+        finally:
+            closeh5(filename)
+        rememberformat(filename, obj.__class__)
         return obj  # return the successfully read object
 
 
@@ -223,11 +621,14 @@ fabio.openimage.MAGIC_NUMBERS.append(tuple([b"\x89\x48\x44\x46", 'h5']))
 @register_fabioclass
 class ALS733H5image(fabioimage):
     extensions = ['h5']
+    _h5 = None
 
     def _readheader(self, f):
         fname = f.name  # get filename from file object
-        with h5py.File(fname, 'r') as h:
-            self.header = dict(h.attrs)
+        if self._h5 is None:
+            self._h5 = openh5(fname)
+            self._h5path = fname
+        self.header = dict(self._h5.attrs)
 
     def read(self, f, frame=None):
         self.readheader(f)
@@ -244,16 +645,31 @@ class ALS733H5image(fabioimage):
             frame = 0
         return self.getframe(frame)
 
+    @staticmethod
+    def _scanlayout(h):
+        dset = h[h.keys()[0]]
+        ddet = dset[dset.keys()[0]]
+        try:
+            keys = ddet.keys()
+        except AttributeError:  # the detector entry is itself the dataset
+            return {'burst': False, 'tiled': False, 'frames': [ddet.name]}
+
+        if u'high' in keys and u'low' in keys:
+            high = ddet[u'high']
+            low = ddet[u'low']
+            frames = [high[high.keys()[0]].name, low[low.keys()[0]].name]
+            return {'burst': False, 'tiled': True, 'frames': frames}
+        return {'burst': True, 'tiled': False, 'frames': [ddet[key].name for key in keys if '.edf' in key]}
+
+    @property
+    def layout(self):
+        return h5layout(self.filename, self._scanlayout)
+
     @property
     def nframes(self):
-        with h5py.File(self.filename, 'r') as h:
-            dset = h[h.keys()[0]]
-            ddet = dset[dset.keys()[0]]
-            if self.isburst:
-                frames = sum(map(lambda key: '.edf' in key, ddet.keys()))
-            else:
-                frames = 1
-        return frames
+        if self.isburst:
+            return len(self.layout['frames'])
+        return 1
 
     def __len__(self):
         return self.nframes
@@ -265,42 +681,24 @@ class ALS733H5image(fabioimage):
     def getframe(self, frame=None):
         if frame is None:
             frame = 0
-        f = self.filename
-        with h5py.File(f, 'r') as h:
-            dset = h[h.keys()[0]]
-            ddet = dset[dset.keys()[0]]
-            if self.isburst:
-                frames = [key for key in ddet.keys() if '.edf' in key]
-                dfrm = ddet[frames[frame]]
-            elif self.istiled:
-                high = ddet[u'high']
-                low = ddet[u'low']
-                frames = [high[high.keys()[0]], low[low.keys()[0]]]
-                dfrm = frames[frame]
-            else:
-                dfrm = ddet
-            self.data = dfrm[0]
+        frames = self.layout['frames']
+        if not self.isburst and not self.istiled:
+            frame = 0
+        self.data = self._h5[frames[frame]][0]
         return self.data
 
     @property
     def isburst(self):
-        try:
-            with h5py.File(self.filename, 'r') as h:
-                dset = h[h.keys()[0]]
-                ddet = dset[dset.keys()[0]]
-                return not (u'high' in ddet.keys() and u'low' in ddet.keys())
-        except AttributeError:
-            return False
+        return self.layout['burst']
 
     @property
     def istiled(self):
-        try:
-            with h5py.File(self.filename, 'r') as h:
-                dset = h[h.keys()[0]]
-                ddet = dset[dset.keys()[0]]
-                return u'high' in ddet.keys() and u'low' in ddet.keys()
-        except AttributeError:
-            return False
+        return self.layout['tiled']
+
+    def close(self):
+        if self._h5 is not None:
+            closeh5(self._h5path)
+            self._h5 = None
 
 
 @register_fabioclass
@@ -340,7 +738,7 @@ class ALS832H5image(fabioimage):
 
             # Check header for unique attributes
             try:
-                self._h5 = h5py.File(self.filename, 'r')
+                self._h5 = openh5(self.filename)
                 self._dgroup = self._finddatagroup(self._h5)
                 self.readheader(f)
                 if self.header['facility'] != 'als' or self.header['end_station'] != 'bl832':
@@ -406,38 +804,26 @@ class ALS832H5image(fabioimage):
     #     return self.sinogram
 
     def __getitem__(self, item):
-        s = []
-        if not isinstance(item, tuple) and not isinstance(item, list):
-            item = (item,)
-        for n in range(3):
-            if n == 0:
-                stop = len(self)
-            elif n == 1:
-                stop = self.data.shape[0]
-            elif n == 2:
-                stop = self.data.shape[1]
-            if n < len(item) and isinstance(item[n], slice):
-                start = item[n].start if item[n].start is not None else 0
-                step = item[n].step if item[n].step is not None else 1
-                stop = item[n].stop if item[n].stop is not None else stop
-            elif n < len(item) and isinstance(item[n], int):
-                if item[n] < 0:
-                    start, stop, step = stop + item[n], stop + item[n] + 1, 1
-                else:
-                    start, stop, step = item[n], item[n] + 1, 1
-            else:
-                start, step = 0, 1
-
-            s.append((start, stop, step))
-
-        for n, i in enumerate(range(s[0][0], s[0][1], s[0][2])):
-            _arr = self._dgroup[self.frames[i]][0, slice(*s[1]), slice(*s[2])]
-            if n == 0:  # allocate array
-                arr = np.empty((len(range(s[0][0], s[0][1], s[0][2])), _arr.shape[0], _arr.shape[1]))
-            arr[n] = _arr
-        if arr.shape[0] == 1:
-            arr = arr[0]
-        return np.squeeze(arr)
+        return np.squeeze(self.readstack(item))
+
+    def readstack(self, item, out=None):
+        """
+        Read a selection of the (projections, rows, cols) stack, each projection read directly into a buffer of the
+        source dtype.
+
+        :param item: ints and slices along the stack axes, as for __getitem__
+        :param out: optional C-contiguous array of the selection shape to read into
+        :return: (frames, rows, cols) array of the selection
+        """
+        s = stackselection(item, (len(self),) + self.data.shape)
+        rows, cols = slice(*s[1]), slice(*s[2])
+        frames = xrange(*s[0])
+        if out is None:
+            out = np.empty(selectionshape(s), dtype=self._dgroup[self.frames[0]].dtype)
+        if out.size:
+            for n, i in enumerate(frames):
+                self._dgroup[self.frames[i]].read_direct(out, np.s_[0, rows, cols], np.s_[n])
+        return out
 
     def __len__(self):
         return self.nframes
@@ -461,7 +847,9 @@ class ALS832H5image(fabioimage):
             raise StopIteration
 
     def close(self):
-        self._h5.close()
+        if self._h5 is not None:
+            closeh5(self.filename)
+            self._h5 = None
 
 
 @register_fabioclass
@@ -500,7 +888,7 @@ class GeneralAPSH5image(fabioimage):
         if self._h5 is None:
 
             # Check header for unique attributes
-            self._h5 = h5py.File(self.filename, 'r')
+            self._h5 = openh5(self.filename)
             self._dgroup = self._finddatagroup(self._h5)
             self.readheader(f)
 
@@ -564,38 +952,26 @@ class GeneralAPSH5image(fabioimage):
     #     return self.sinogram
 
     def __getitem__(self, item):
-        s = []
-        if not isinstance(item, tuple) and not isinstance(item, list):
-            item = (item, )
-        for n in range(3):
-            if n == 0:
-                stop = len(self)
-            elif n == 1:
-                stop = self.data.shape[0]
-            elif n == 2:
-                stop = self.data.shape[1]
-            if n < len(item) and isinstance(item[n], slice):
-                    start = item[n].start if item[n].start is not None else 0
-                    step = item[n].step if item[n].step is not None else 1
-                    stop = item[n].stop if item[n].stop is not None else stop
-            elif n < len(item) and isinstance(item[n], int):
-                    if item[n] < 0:
-                        start, stop, step = stop + item[n], stop + item[n] + 1, 1
-                    else:
-                        start, stop, step = item[n], item[n] + 1, 1
-            else:
-                start, step = 0, 1
-
-            s.append((start, stop, step))
-
-        for n, i in enumerate(range(s[0][0], s[0][1], s[0][2])):
-            _arr = self._dgroup[self.frames[i]][slice(*s[1]), slice(*s[2])]
-            if n == 0:  # allocate array
-                arr = np.empty((len(range(s[0][0], s[0][1], s[0][2])), _arr.shape[0], _arr.shape[1]))
-            arr[n] = _arr
-        if arr.shape[0] == 1:
-            arr = arr[0]
-        return np.squeeze(arr)
+        return np.squeeze(self.readstack(item))
+
+    def readstack(self, item, out=None):
+        """
+        Read a selection of the (projections, rows, cols) dataset as a single hyperslab in the source dtype.
+
+        :param item: ints and slices along the stack axes, as for __getitem__
+        :param out: optional C-contiguous array of the selection shape to read into
+        :return: (frames, rows, cols) array of the selection
+        """
+        s = stackselection(item, (len(self),) + self.data.shape)
+        if out is None:
+            out = np.empty(selectionshape(s), dtype=self._dgroup.dtype)
+        if out.size:
+            if s[0][2] > 0:
+                self._dgroup.read_direct(out, tuple(slice(*axis) for axis in s))
+            else:  # hdf5 selections can't step backwards; read frame by frame
+                for n, i in enumerate(xrange(*s[0])):
+                    self._dgroup.read_direct(out, np.s_[i, slice(*s[1]), slice(*s[2])], np.s_[n])
+        return out
 
     def __len__(self):
         return self.nframes
@@ -619,7 +995,9 @@ class GeneralAPSH5image(fabioimage):
             raise StopIteration
 
     def close(self):
-        self._h5.close()
+        if self._h5 is not None:
+            closeh5(self.filename)
+            self._h5 = None
 
 @register_fabioclass
 class DXchangeH5image(fabioimage):
@@ -655,7 +1033,7 @@ class DXchangeH5image(fabioimage):
         if frame is None:
             frame = 0
         if self._h5 is None:
-            self._h5 = h5py.File(self.filename, 'r')
+            self._h5 = openh5(self.filename)
             self._dgroup = self._finddatagroup(self._h5)
         self.readheader(f)
         self.currentframe = frame
@@ -709,7 +1087,9 @@ class DXchangeH5image(fabioimage):
             raise StopIteration
 
     def close(self):
-        self._h5.close()
+        if self._h5 is not None:
+            closeh5(self.filename)
+            self._h5 = None
 
 
 class TiffStack(object):
@@ -730,7 +1110,7 @@ class TiffStack(object):
         return len(self.frames)
 
     def getframe(self, frame=0):
-        self.data = tifffile.imread(self.frames[frame], memmap=True)
+        self.data = maptiff(self.frames[frame], mapped=True)[0]
         return self.data
 
     def close(self):
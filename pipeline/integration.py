@@ -2,10 +2,203 @@ import numpy as np
 from xicam import config
 from PySide import QtCore
 import multiprocessing
+import threading
+import hashlib
 import time
 import pyFAI
+from pyFAI import geometry
 import remesh
 import msg
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+import h5py
+
+# Process-wide integrator cache. pyFAI keeps its lookup table on the AzimuthalIntegrator instance, so handing back the
+# same configured integrator for a repeated (geometry, shape, mask, bins) request skips the LUT rebuild entirely.
+integratorcachebytes = 1024 * 2 ** 20  # memory cap for cached integrators/LUTs
+_integratorcache = OrderedDict()
+_integratorcachelock = threading.Lock()
+_integratorcachestats = {'hits': 0, 'misses': 0}
+
+
+def maskdigest(mask):
+    """
+    Short digest of a mask's contents, suitable as part of a cache key
+    """
+    if mask is None:
+        return None
+    mask = np.asarray(mask)
+    # Masks are used as booleans everywhere; packing them first keeps hashing cheap on large detectors
+    return hashlib.md5(np.packbits(mask.astype(bool).ravel())).hexdigest() + str(mask.shape)
+
+
+def geometrykey(AIdict, shape, mask=None, bins=None):
+    """
+    Hashable key identifying an integration geometry; the geometry dict is order-independent. The key is the full tuple
+    rather than its hash, so that two geometries can never share cache entries.
+    """
+    geometry = tuple(sorted((key, repr(value)) for key, value in AIdict.items()))
+    return geometry, tuple(shape), maskdigest(mask), repr(bins)
+
+
+def _estimateintegratorbytes(shape, bins):
+    # LUT (index+coefficient per pixel and neighbour) plus pyFAI's cached per-pixel position/solid-angle arrays
+    return int(np.prod(shape)) * 48 + int(np.prod(bins or 0)) * 16
+
+
+def _cacheget(key):
+    with _integratorcachelock:
+        if key in _integratorcache:
+            _integratorcachestats['hits'] += 1
+            entry = _integratorcache.pop(key)
+            _integratorcache[key] = entry  # move to most recently used
+            return entry[0]
+        _integratorcachestats['misses'] += 1
+    return None
+
+
+def _cacheput(key, value, nbytes):
+    with _integratorcachelock:
+        _integratorcache[key] = (value, nbytes)
+        total = sum(size for _, size in _integratorcache.values())
+        while total > integratorcachebytes and len(_integratorcache) > 1:
+            _, (_, size) = _integratorcache.popitem(last=False)
+            total -= size
+    return value
+
+
+def getintegrator(AIdict, shape, mask=None, bins=None):
+    """
+    Get a configured AzimuthalIntegrator from the process-wide cache, building it on first use. The least recently used
+    integrators are evicted once the estimated memory of the cache exceeds integratorcachebytes.
+
+    :param AIdict: dict from AzimuthalIntegrator.getPyFAI()
+    :param shape: shape of the image to be integrated (as passed to pyFAI)
+    :param mask: mask used for the integration (any convention, only its contents are hashed)
+    :param bins: bin count (int for 1D, tuple for 2D)
+    :rtype : pyFAI.AzimuthalIntegrator
+    """
+    key = ('integrator', geometrykey(AIdict, shape, mask, bins))
+    AI = _cacheget(key)
+    if AI is None:
+        AI = pyFAI.AzimuthalIntegrator()
+        AI.setPyFAI(**AIdict)
+        _cacheput(key, AI, _estimateintegratorbytes(shape, bins))
+    return AI
+
+
+def clearintegratorcache():
+    with _integratorcachelock:
+        _integratorcache.clear()
+
+
+def integratorcachestats():
+    """
+    Return hit/miss counters, number of cached integrators and their estimated size in bytes
+    """
+    with _integratorcachelock:
+        stats = dict(_integratorcachestats)
+        stats['entries'] = len(_integratorcache)
+        stats['bytes'] = sum(nbytes for _, nbytes in _integratorcache.values())
+    return stats
+
+
+def _openclavailable():
+    try:
+        from pyFAI.opencl import ocl
+    except ImportError:
+        return False
+    return ocl is not None
+
+
+# Integration backends, as pyFAI integration methods, in order of preference when timings tie. 'sparse' is the batched
+# bin matrix of multiintegrate, which also integrates every ROI in the same pass; it only serves the q and chi modes of
+# integraterois, and other pyFAI integrations use 'csr' while it is selected.
+backends = OrderedDict([('sparse', None),
+                        ('csr', 'csr'),
+                        ('numpy', 'numpy'),
+                        ('splitpixel', 'splitpixel'),
+                        ('opencl', 'lut_ocl')])
+backend = None  # name of a backend to force; None auto-selects by benchmark
+_backendchoice = dict()  # image shape -> selected backend name
+_backendlock = threading.Lock()
+
+
+def availablebackends():
+    names = list(backends.keys())
+    if not _openclavailable():
+        names.remove('opencl')
+    return names
+
+
+def benchmarkbackends(AIdict, shape, npt=2000, repeats=2):
+    """
+    Time a 1D integration of an image with the given shape (as passed to pyFAI) with every available backend. The first
+    call of each backend builds its LUT and is not timed.
+
+    :return: OrderedDict of backend name -> seconds per integration; failed backends are omitted
+    """
+    data = np.random.random(shape).astype(np.float32)
+    mask = np.zeros(shape, dtype=np.int8)
+    timings = OrderedDict()
+    for name in availablebackends():
+        if backends[name] is None:
+            def integrate():
+                multiintegrate(data.T, 1 - mask.T, AIdict, bins=npt)
+        else:
+            AI = getintegrator(AIdict, shape, mask, npt)
+
+            def integrate():
+                AI.integrate1d(data, npt, mask=mask, method=backends[name])
+        try:
+            integrate()
+            times = []
+            for _ in range(repeats):
+                start = time.time()
+                integrate()
+                times.append(time.time() - start)
+            timings[name] = min(times)
+        except Exception as ex:
+            msg.logMessage(('Integration backend', name, 'unavailable:', ex), msg.DEBUG)
+    return timings
+
+
+def selectbackend(AIdict, shape):
+    """
+    Name of the integration backend to use for images with the given shape (as passed to pyFAI). Unless a backend is
+    forced with setbackend, the fastest available one is picked by a one-time benchmark per shape.
+    """
+    if backend is not None:
+        return backend
+    shape = tuple(shape)
+    with _backendlock:
+        if shape not in _backendchoice:
+            timings = benchmarkbackends(AIdict, shape)
+            if timings:
+                choice = min(timings, key=timings.get)
+            else:
+                choice = 'numpy'
+            msg.logMessage('Integration backend timings for ' + str(shape) + ': ' +
+                           ', '.join('%s %.1f ms' % (name, t * 1000) for name, t in timings.items()))
+            msg.logMessage('Selected integration backend: ' + choice)
+            _backendchoice[shape] = choice
+        return _backendchoice[shape]
+
+
+def setbackend(name=None):
+    """
+    Force an integration backend by name, or restore automatic selection with None
+    """
+    global backend
+    if name is not None and name not in backends:
+        raise KeyError('Unknown integration backend: ' + name)
+    backend = name
+    msg.logMessage('Integration backend set to: ' + str(name))
+
+
+def integrationmethod(AIdict, shape):
+    return backends[selectbackend(AIdict, shape)] or 'csr'
 #
 #
 # def radialintegrate(dimg, cut=None):
@@ -85,6 +278,142 @@ import msg
 #     return (q, radialprofile)
 
 
+class pixelmap(object):
+    """
+    Precomputed flat radius and chi bin indices for an image shape and center, as used by pixel_2Dintegrate and
+    chi_2Dintegrate. Pixels are also kept sorted by radius so a ring can be selected without scanning the full frame.
+    """
+
+    def __init__(self, shape, center, chires=30):
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        self.chires = chires
+
+        x, y = np.indices(shape).astype(np.float)
+        x -= center[0]
+        y -= center[1]
+        self.r = np.sqrt(x ** 2 + y ** 2).astype(np.int32).ravel()
+        self.nr = int(self.r.max()) + 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chi = chires * np.arctan(y / x)
+        chi += chires * np.pi / 2.
+        chi = np.round(np.nan_to_num(chi)).astype(np.int32).ravel()
+        chi *= (chi > 0)
+        self.nchi = int(chi.max()) + 1
+        chi[(x >= 0).ravel()] = self.nchi  # only x < cen[0] contributes to chi profiles; park the rest in a spare bin
+        self.chi = chi
+
+        self.rorder = np.argsort(self.r, kind='mergesort').astype(np.int32)
+        self.rstarts = np.concatenate([[0], np.cumsum(np.bincount(self.r, minlength=self.nr))])
+
+        self._counts = OrderedDict()  # mask digest -> per-radius normalisation counts
+        self._joint = None
+
+    @property
+    def nbytes(self):
+        return self.r.nbytes + self.chi.nbytes + self.rorder.nbytes + self.rstarts.nbytes + \
+               sum(counts.nbytes for counts in self._counts.values()) + \
+               (self._joint.nbytes if self._joint is not None else 0)
+
+    @property
+    def joint(self):
+        """
+        Flat joint (r, chi) bin index; the chi axis has nchi + 1 columns, the last holding pixels with x >= cen[0]
+        """
+        if self._joint is None:
+            self._joint = self.r * np.int32(self.nchi + 1) + self.chi
+        return self._joint
+
+    def histogram(self, data, weights=None):
+        """
+        Joint (r x chi) binned integration of data in a single pass; weights is the (1-valid) mask
+
+        :rtype : rchihistogram
+        """
+        nbins = self.nr * (self.nchi + 1)
+        if weights is None:
+            sums = np.bincount(self.joint, np.ravel(data), minlength=nbins)
+            counts = np.bincount(self.joint, minlength=nbins)
+        else:
+            sums = np.bincount(self.joint, np.ravel(data * weights), minlength=nbins)
+            counts = np.bincount(self.joint, np.ravel(weights), minlength=nbins)
+        return rchihistogram(sums.reshape(self.nr, -1), counts.reshape(self.nr, -1), self.nchi)
+
+    def radialcounts(self, weights):
+        key = maskdigest(weights)
+        if key not in self._counts:
+            if len(self._counts) > 3: self._counts.popitem(last=False)
+            self._counts[key] = np.bincount(self.r, np.ravel(weights), minlength=self.nr)
+        return self._counts[key]
+
+    def radialprofile(self, data, weights):
+        """
+        Average of data over integer radius bins, with weights as the (1-valid) mask
+        """
+        tbin = np.bincount(self.r, np.ravel(data * weights), minlength=self.nr)
+        return tbin / self.radialcounts(weights)
+
+    def ring(self, rinf, rsup):
+        """
+        Flat indices of the pixels with rinf < r < rsup
+        """
+        lo = min(max(int(np.floor(rinf)) + 1, 0), self.nr)
+        hi = min(max(int(np.ceil(rsup)), lo), self.nr)
+        return self.rorder[self.rstarts[lo]:self.rstarts[hi]]
+
+    def chiprofile(self, data, mu, mask=None, delta=3):
+        """
+        Average of data over chi bins within a ring of width delta around radius mu; mask is 1-invalid
+        """
+        pixels = self.ring(mu - delta / 2., mu + delta / 2.)
+        chi = self.chi[pixels]
+        values = np.ravel(data)[pixels]
+        if mask is not None:
+            values = values * (1 - np.ravel(mask)[pixels])
+        tbin = np.bincount(chi, values, minlength=self.nchi + 1)
+        nr = np.bincount(chi, minlength=self.nchi + 1)
+        return (tbin / nr)[:self.nchi]
+
+
+class rchihistogram(object):
+    """
+    Summed intensity and pixel counts binned jointly over integer radius (rows) and chi (columns), from which radial
+    and per-ring chi profiles are read without revisiting the image
+    """
+
+    def __init__(self, sums, counts, nchi):
+        self.sums = sums
+        self.counts = counts
+        self.nchi = nchi
+
+    def radialprofile(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sums.sum(axis=1) / self.counts.sum(axis=1)
+
+    def chiprofile(self, mu, delta=3):
+        """
+        Chi profile of the ring rinf < r < rsup around radius mu, as chi_2Dintegrate
+        """
+        nr = len(self.sums)
+        lo = min(max(int(np.floor(mu - delta / 2.)) + 1, 0), nr)
+        hi = min(max(int(np.ceil(mu + delta / 2.)), lo), nr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sums[lo:hi, :self.nchi].sum(axis=0) / self.counts[lo:hi, :self.nchi].sum(axis=0)
+
+
+def getpixelmap(shape, center, chires=30):
+    """
+    Get the pixelmap for (shape, center, chires) from the process-wide cache, building it on first use
+    """
+    key = ('pixelmap', tuple(shape), tuple(float(c) for c in center), chires)
+    pmap = _cacheget(key)
+    if pmap is None:
+        pmap = pixelmap(shape, center, chires)
+        _cacheput(key, pmap, pmap.nbytes)
+    return pmap
+
+
 def pixel_2Dintegrate(dimg, mask=None):
     centerx = dimg.experiment.getvalue('Center X')
     centery = dimg.experiment.getvalue('Center Y')
@@ -93,17 +422,10 @@ def pixel_2Dintegrate(dimg, mask=None):
         msg.logMessage("No mask defined, creating temporary empty mask.",msg.INFO)
         mask = np.zeros_like(dimg.rawdata)
 
-    # mask data
-    data = dimg.transformdata * (mask)
+    data = dimg.transformdata
 
     # calculate data radial profile
-    x, y = np.indices(data.shape)
-    r = np.sqrt((x - centerx) ** 2 + (y - centery) ** 2)
-    r = r.astype(np.int)
-
-    tbin = np.bincount(r.ravel(), data.ravel())
-    nr = np.bincount(r.ravel(), (mask).ravel())
-    radialprofile = tbin / nr
+    radialprofile = getpixelmap(data.shape, (centerx, centery)).radialprofile(data, mask)
 
     return radialprofile
 
@@ -114,31 +436,8 @@ def chi_2Dintegrate(imgdata, cen, mu, mask=None, chires=30):
     """
     if mask is None:
         msg.logMessage("No mask defined, creating temporary empty mask..",msg.INFO)
-        mask = np.zeros_like(imgdata)
-
-    # mask data
-    data = imgdata * (1 - mask)
-
-    x, y = np.indices(data.shape).astype(np.float)
-    r = np.sqrt((x - cen[0]) ** 2 + (y - cen[1]) ** 2)
-    r = r.astype(np.int)
-
-    delta = 3
-
-    rinf = mu - delta / 2.
-    rsup = mu + delta / 2.
 
-    rmask = ((rinf < r) & (r < rsup) & (x < cen[0])).astype(np.int)
-    data *= rmask
-
-    chi = chires * np.arctan((y - cen[1]) / (x - cen[0]))
-    chi += chires * np.pi / 2.
-    chi = np.round(chi).astype(np.int)
-    chi *= (chi > 0)
-
-    tbin = np.bincount(chi.ravel(), data.ravel())
-    nr = np.bincount(chi.ravel(), rmask.ravel())
-    angleprofile = tbin / nr
+    angleprofile = getpixelmap(imgdata.shape, cen, chires).chiprofile(imgdata, mu, mask)
 
     # vimodel = pymodelfit.builtins.GaussianModel()
     # vimodel.mu = np.pi / 2 * 100
@@ -149,19 +448,30 @@ def chi_2Dintegrate(imgdata, cen, mu, mask=None, chires=30):
     return angleprofile
 
 
+def rchi_2Dintegrate(imgdata, cen, mask=None, chires=30):
+    """
+    Joint integration over (r, chi) in one pass over the image. Radial and per-ring chi profiles are read from the
+    returned histogram as slices; mask is 1-valid.
+
+    :rtype : rchihistogram
+    """
+    if mask is not None and not mask.shape == imgdata.shape:
+        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
+        mask = None
+
+    return getpixelmap(imgdata.shape, cen, chires).histogram(imgdata, mask)
+
+
 
 
 #@debugtools.timeit
 def radialintegratepyFAI(data, mask=None, AIdict=None, cut=None, color=[255, 255, 255], requestkey = None, qvrt = None, qpar = None):
     if mask is None: mask = config.activeExperiment.mask
     if AIdict is None:
-        AI = config.activeExperiment.getAI()
+        AIdict = config.activeExperiment.getAI().getPyFAI()
         # p1 = AI.get_poni1()
         # p2 = AI.get_poni2()
         # msg.logMessage(('poni:', p1, p2),msg.DEBUG)
-    else:
-        AI = pyFAI.AzimuthalIntegrator()
-        AI.setPyFAI(**AIdict)
 
 
     if mask is not None:
@@ -180,16 +490,81 @@ def radialintegratepyFAI(data, mask=None, AIdict=None, cut=None, color=[255, 255
         mask = mask.astype(bool) & cut.astype(bool)
 
     xres = 2000
-    (q, radialprofile) = AI.integrate1d(data.T, xres, mask=1 - mask.T, method='lut_ocl')  #pyfai uses 0-valid mask
+    AI = getintegrator(AIdict, data.T.shape, mask, xres)
+    (q, radialprofile) = AI.integrate1d(data.T, xres, mask=1 - mask.T,
+                                        method=integrationmethod(AIdict, data.T.shape))  #pyfai uses 0-valid mask
 
     q = q/10.
 
     return q, radialprofile, color, requestkey
 
 
+def integrate_stack(simg, mask=None, AIdict=None, npt=2000, path=None, threads=None):
+    """
+    Radially integrate every frame of a multi-frame image (multifilediffimage2, stackdiffimage2) into a contiguous
+    (frame x q) float32 array. Frames are read and integrated on a thread pool sharing one cached integrator/LUT.
+
+    :param simg: image series providing scanframe(i) (or rawframe(i)), shape and optionally xvals
+    :param mask: 1-valid mask in xicam orientation; defaults to the active experiment's mask
+    :param AIdict: dict from AzimuthalIntegrator.getPyFAI(); defaults to the active experiment's geometry
+    :param npt: number of q bins
+    :param path: optional HDF5 file to write 'q', 'xvals' and 'I' datasets to as frames complete
+    :param threads: worker count; defaults to the number of CPUs
+    :return: q (A^-1), I (frames x npt), xvals
+    """
+    if AIdict is None: AIdict = config.activeExperiment.getAI().getPyFAI()
+    if mask is None: mask = config.activeExperiment.mask
+
+    nframes = simg.shape[0]
+    shape = simg.shape[1:]
+    if mask is None or not mask.shape == shape:
+        msg.logMessage("No mask match. Mask will be ignored.", msg.WARNING)
+        mask = np.ones(shape, dtype=np.int)
+
+    try:
+        xvals = np.asarray(simg.xvals(''), dtype=np.float)
+    except AttributeError:
+        xvals = np.arange(nframes, dtype=np.float)
+
+    AI = getintegrator(AIdict, shape[::-1], mask, npt)
+    method = integrationmethod(AIdict, shape[::-1])
+    pyfaimask = 1 - mask.T  # pyfai uses 0-valid mask
+    # Frames are read past the shared frame cache, which would otherwise be filled with the whole series
+    readframe = getattr(simg, 'scanframe', simg.rawframe)
+
+    def integrateframe(i):
+        q, I = AI.integrate1d(readframe(i).T, npt, mask=pyfaimask, method=method)
+        return i, q, I
+
+    result = np.empty((nframes, npt), dtype=np.float32)
+    q = None
+
+    h5file = None
+    if path is not None:
+        h5file = h5py.File(path, 'w')
+        dataset = h5file.create_dataset('I', shape=(nframes, npt), dtype=np.float32, chunks=(max(1, min(nframes, 64)), npt))
+        h5file.create_dataset('xvals', data=xvals)
+
+    pool = ThreadPool(threads or multiprocessing.cpu_count())
+    start = time.time()
+    try:
+        for i, frameq, I in pool.imap(integrateframe, range(nframes), chunksize=4):
+            result[i] = I
+            if q is None:
+                q = frameq / 10.
+                if h5file is not None: h5file.create_dataset('q', data=q)
+            if h5file is not None:
+                dataset[i] = I
+    finally:
+        pool.terminate()
+        if h5file is not None:
+            h5file.close()
+
+    msg.logMessage('Integrated %d frames in %.1f s' % (nframes, time.time() - start))
+    return q, result, xvals
+
+
 def chiintegratepyFAI(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey = None, qvrt = None, qpar = None, xres=1000, yres=1000):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
     # Always do mask with 1-valid, 0's excluded
 
     if mask is not None:
@@ -209,79 +584,103 @@ def chiintegratepyFAI(data, mask, AIdict, cut=None, color=[255, 255, 255], reque
     # data *= cut
 
 
-    cake, q, chi = AI.integrate2d(data.T, xres, yres, mask=1 - mask.T, method='lut_ocl')
-    mask, q, chi = AI.integrate2d(1 - mask.T, xres, yres, mask=1 - mask.T, method='lut_ocl')
-
-    maskedcake = np.ma.masked_array(cake, mask=mask)
+    cake, coverage, q, chi = cake2d(data, mask, AIdict, xres, yres, method=integrationmethod(AIdict, data.T.shape))
 
-    chiprofile = np.ma.average(maskedcake, axis=1)
+    # average over q, skipping cake bins no pixel contributes to
+    chiprofile = lineprofile(cake, coverage > 0, axis=1)
 
     return chi, chiprofile, color, requestkey
 
-def xintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey = None, qvrt = None, qpar = None):
-    if mask is not None:
-        mask = mask.copy()
-
-    msg.logMessage(('image:', data.shape),msg.DEBUG)
-    msg.logMessage(('mask:', mask.shape),msg.DEBUG)
-
-    if not mask.shape == data.shape:
+def lineprofile(data, mask, cut=None, axis=1):
+    """
+    Masked average of data along one axis, computed as weighted sums without building masked arrays. mask and cut are
+    1-valid; lines with no valid pixels are 0.
+    """
+    if mask is None or not mask.shape == data.shape:
         msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
-        mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.INFO)
+        weights = np.ones(data.shape, dtype=bool)
+    else:
+        weights = mask.astype(bool)
 
     if cut is not None:
         msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
-    # data *= cut
+        weights &= cut.astype(bool)
 
+    subscripts = 'ij,ij->i' if axis == 1 else 'ij,ij->j'
+    sums = np.einsum(subscripts, data, weights, dtype=np.float64, casting='unsafe')  # integer frames would wrap
+    counts = weights.sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, 0)
 
-    maskeddata = np.ma.masked_array(data, mask=1-mask)
 
-    xprofile = np.ma.average(maskeddata, axis=1)
+def qline(AIdict, shape, axis=1):
+    """
+    q values (A^-1) along the line through the beam center used as the axis of a horizontal (axis=1) or vertical
+    (axis=0) line cut of an image with the given shape. Only that line is evaluated, and the result is cached.
+    """
+    key = ('qline', axis, geometrykey(AIdict, shape))
+    q = _cacheget(key)
+    if q is None:
+        AI = getintegrator(AIdict, shape[::-1])
+        f2d = AI.getFit2D()
+        # pyFAI works on the transposed image; rows of the line cut are its second index
+        if axis == 1:
+            n = shape[0]
+            q = AI.qFunction(np.full(n, int(f2d['centerY']), dtype=np.float), np.arange(n, dtype=np.float)) / 10
+        else:
+            n = shape[1]
+            q = AI.qFunction(np.arange(n, dtype=np.float), np.full(n, int(f2d['centerX']), dtype=np.float)) / 10
+        q = np.array(q, dtype=np.float)
+        q[:q.argmin()] *= -1
+        _cacheput(key, q, q.nbytes)
+    return q.copy()
+
+
+def xintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey = None, qvrt = None, qpar = None):
+    msg.logMessage(('image:', data.shape),msg.DEBUG)
 
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
-    qx = AI.qArray(data.shape[::-1])[AI.getFit2D()['centerY'],:]/10
-    qx[:qx.argmin()]*=-1
+    xprofile = lineprofile(data, mask, cut, axis=1)
+    qx = qline(AIdict, data.shape, axis=1)
 
     return qx, xprofile, color, requestkey
 
 
 def zintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey = None, qvrt = None, qpar = None):
-    if mask is not None:
-        mask = mask.copy()
-
     msg.logMessage(('image:', data.shape),msg.DEBUG)
-    msg.logMessage(('mask:', mask.shape),msg.DEBUG)
 
-    if not mask.shape == data.shape:
-        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
-        mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.DEBUG)
+    xprofile = lineprofile(data, mask, cut, axis=0)
+    qz = qline(AIdict, data.shape, axis=0)
 
-    if cut is not None:
-        msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
-    # data *= cut
+    return qz, xprofile, color, requestkey
 
 
-    maskeddata = np.ma.masked_array(data, mask=1-mask)
+def cake2d(data, mask, AIdict, xres=1000, yres=1000, method=None):
+    """
+    Cake (chi x q regrouped) image of data from a single integration pass, with the per-bin coverage of the valid
+    detector area. Coverage depends only on the geometry and mask, so it is computed once and shared by every frame.
 
-    xprofile = np.ma.average(maskeddata, axis=0)
+    :param mask: 1-valid mask in xicam orientation
+    :param method: pyFAI integration method; None uses pyFAI's default
+    :return: cake, coverage (0 where no valid pixel contributes), q, chi
+    """
+    kwargs = {} if method is None else {'method': method}
+    pyfaimask = 1 - mask.T  # pyfai uses 0-valid mask
+    AI = getintegrator(AIdict, data.T.shape, mask, (xres, yres))
 
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
-    qz = AI.qArray(data.shape[::-1])[:,AI.getFit2D()['centerX']]/10
-    qz[:qz.argmin()]*=-1
+    key = ('coverage', repr(method), geometrykey(AIdict, data.T.shape, mask, (xres, yres)))
+    coverage = _cacheget(key)
+    if coverage is None:
+        coverage, _, _ = AI.integrate2d(np.ones(data.T.shape, dtype=np.float32), xres, yres, mask=pyfaimask, **kwargs)
+        _cacheput(key, coverage, coverage.nbytes)
 
-    return qz, xprofile, color, requestkey
+    cake, q, chi = AI.integrate2d(data.T, xres, yres, mask=pyfaimask, **kwargs)
+    return cake, coverage, q, chi
 
 
 def cake(imgdata, experiment, mask=None, xres=1000, yres=1000):
     if mask is None:
         mask = np.zeros_like(imgdata)
-    AI = experiment.getAI()
+    AI = getintegrator(experiment.getAI().getPyFAI(), imgdata.T.shape, mask, (xres, yres))
     """:type : pyFAI.AzimuthalIntegrator"""
 
     return AI.integrate2d(imgdata.T, xres, yres, mask=1-mask.T)
@@ -308,50 +707,45 @@ def qintegrate(*args,**kwargs):
          return radialintegratepyFAI(*args,**kwargs)
 
 def cakexintegrate(data, mask, AIdict, cut=None, color=[255,255,255], requestkey=None, qvrt = None, qpar = None):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
-
-    if not mask.shape == data.shape:
-        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
-        mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.DEBUG)
-
-    if cut is not None:
-        msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
-
     chi = np.arange(-180,180,360/1000.)
 
-    maskeddata = np.ma.masked_array(data, mask=1-mask)
-    xprofile = np.ma.average(maskeddata, axis=1)
+    xprofile = lineprofile(data, mask, cut, axis=1)
 
     return chi, xprofile, color, requestkey
 
 def cakezintegrate(data, mask, AIdict, cut=None, color=[255,255,255], requestkey=None, qvrt = None, qpar = None):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
-
-    if not mask.shape == data.shape:
-        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
-        mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.DEBUG)
-
-    if cut is not None:
-        msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
-
     q = np.arange(1000)*np.max(qpar)/10000.
 
-    maskeddata = np.ma.masked_array(data, mask=1-mask)
-    zprofile = np.ma.average(maskeddata, axis=0)
+    zprofile = lineprofile(data, mask, cut, axis=0)
 
     return q, zprofile, color, requestkey
 
+def remeshgeometry(AIdict, shape, qpar, qvrt):
+    """
+    Geometry (as AzimuthalIntegrator.getPyFAI()) of a remeshed image, with the beam center moved to its q origin.
+    Cached per geometry and center, so repeated integrations reuse the integrator of the corrected geometry.
+    """
+    qsquared = qpar ** 2 + qvrt ** 2
+    remeshcenter = np.unravel_index(qsquared.argmin(), qsquared.shape)
+
+    key = ('remeshgeometry', remeshcenter, geometrykey(AIdict, shape))
+    corrected = _cacheget(key)
+    if corrected is None:
+        f2d = getintegrator(AIdict, shape).getFit2D()
+        f2d['centerX'] = remeshcenter[0]
+        f2d['centerY'] = remeshcenter[1]
+        # Converted on a bare geometry; the cached integrator itself must not be moved
+        centered = geometry.Geometry()
+        centered.setFit2D(**f2d)
+        corrected = dict(AIdict)
+        corrected.update((name, value) for name, value in centered.getPyFAI().items()
+                         if name in ('dist', 'poni1', 'poni2', 'rot1', 'rot2', 'rot3'))
+        msg.logMessage('remesh corrected calibration: ' + str(corrected))
+        _cacheput(key, corrected, 0)
+    return corrected
 
-def remeshqintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt = None, qpar = None):
 
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
+def remeshqintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt = None, qpar = None):
 
     alphai=config.activeExperiment.getvalue('Incidence Angle (GIXS)')
     msg.logMessage('Incoming angle applied to remeshed q integration: ' + str(alphai),msg.DEBUG)
@@ -359,17 +753,7 @@ def remeshqintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], reques
     #qpar, qvrt = remesh.remeshqarray(data, None, AI, np.deg2rad(alphai))
     qsquared=qpar**2 + qvrt**2
 
-
-    remeshcenter=np.unravel_index(qsquared.argmin(),qsquared.shape)
-
-    print 'center?:',remeshcenter
-
-    f2d=AI.getFit2D()
-    f2d['centerX']=remeshcenter[0]
-    f2d['centerY']=remeshcenter[1]
-    AI.setFit2D(**f2d)
-    AIdict=AI.getPyFAI()
-    msg.logMessage('remesh corrected calibration: '+str(AIdict))
+    AIdict = remeshgeometry(AIdict, data.T.shape, qpar, qvrt)
 
     q,qprofile,color,requestkey = qintegrate(data,mask,AIdict,cut,color,requestkey, qvrt = None, qpar = None)
 
@@ -382,62 +766,195 @@ def remeshqintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], reques
     return q, qprofile, color, requestkey
 
 def remeshchiintegrate(data,mask,AIdict,cut=None, color=[255,255,255],requestkey=None, qvrt = None, qpar = None):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
-
     alphai=config.activeExperiment.getvalue('Incidence Angle (GIXS)')
     msg.logMessage('Incoming angle applied to remeshed q integration: ' + str(alphai),msg.DEBUG)
 
-    qsquared=qpar**2 + qvrt**2
-
-    remeshcenter=np.unravel_index(qsquared.argmin(),qsquared.shape)
-
-    f2d=AI.getFit2D()
-    f2d['centerX']=remeshcenter[0]
-    f2d['centerY']=remeshcenter[1]
-    AI.setFit2D(**f2d)
-    AIdict=AI.getPyFAI()
+    AIdict = remeshgeometry(AIdict, data.T.shape, qpar, qvrt)
 
     return chiintegratepyFAI(data,mask,AIdict,cut,color,requestkey, qvrt = None, qpar = None)
 
 def remeshxintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt = None, qpar = None):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
+    # qpar is a (rotated) meshgrid, so one line through its minimum is the whole axis
+    center = np.unravel_index(np.abs(qpar).argmin(), qpar.shape)
+    qx = qpar[:,center[0]]/10.
 
-    if not mask.shape == data.shape:
-        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
-        mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.DEBUG)
+    xprofile = lineprofile(data, mask, cut, axis=1)
 
-    if cut is not None:
-        msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
+    return qx, xprofile, color, requestkey
 
-    center = np.where(np.abs(qpar) == np.abs(qpar).min())
-    qx = qpar[:,center[0][0]]/10.
+def remeshzintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt = None, qpar = None):
+    center = np.unravel_index(np.abs(qvrt).argmin(), qvrt.shape)
+    qx = -qvrt[center[1]]/10.
 
-    maskeddata = np.ma.masked_array(data, mask=1 - mask)
-    xprofile = np.ma.average(maskeddata, axis=1)
+    xprofile = lineprofile(data, mask, cut, axis=0)
 
     return qx, xprofile, color, requestkey
 
-def remeshzintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt = None, qpar = None):
-    AI = pyFAI.AzimuthalIntegrator()
-    AI.setPyFAI(**AIdict)
+def _gixsposition(AI, shape, alphai, axis):
+    # per-pixel GIXS coordinate of an image in xicam orientation; remesh works on the image rotated back by 90 degrees
+    qp, qz = remesh.pixelqmap(shape[::-1], AI, alphai)
+    qp = np.rot90(qp, 3).ravel() / 10.
+    qz = np.rot90(qz, 3).ravel() / 10.
+    if axis == 'q':
+        return np.sqrt(qp ** 2 + qz ** 2)
+    elif axis == 'chi':
+        return np.rad2deg(np.arctan2(qz, qp))
+    elif axis == 'qpar':
+        return qp
+    elif axis == 'qz':
+        return qz
+    raise ValueError('Unknown GIXS integration axis: ' + str(axis))
+
+
+def binmatrix(AIdict, shape, mask, bins, axis='q', alphai=None):
+    """
+    Sparse (bins x pixels) bin-assignment matrix for an image in xicam orientation. Each valid pixel (mask is 1-valid)
+    has a single unit entry in the row of its q (A^-1) or chi (degrees) bin. Cached alongside the integrators.
 
-    if not mask.shape == data.shape:
-        msg.logMessage("No mask match. Mask will be ignored.",msg.WARNING)
+    If an incidence angle alphai (radians) is given, pixels are binned by their GIXS coordinates instead: |q|, chi,
+    q_par or q_z ('q', 'chi', 'qpar', 'qz'), computed directly from the detector geometry.
+
+    :return: (matrix, bin centers, per-pixel solid angle)
+    """
+    key = ('binmatrix', axis, alphai, geometrykey(AIdict, shape, mask, bins))
+    entry = _cacheget(key)
+    if entry is None:
+        AI = getintegrator(AIdict, shape[::-1])
+        pixels = np.flatnonzero(mask)
+        if alphai is not None:
+            position = _gixsposition(AI, shape, alphai, axis)[pixels]
+        elif axis == 'q':
+            position = AI.qArray(shape[::-1]).T.ravel()[pixels] / 10.
+        elif axis == 'chi':
+            position = np.rad2deg(AI.chiArray(shape[::-1]).T.ravel()[pixels])
+        else:
+            raise ValueError('Unknown integration axis: ' + str(axis))
+        if axis == 'chi':
+            lo, hi = -180., 180.
+        elif len(position) and position.max() > position.min():
+            lo, hi = position.min(), position.max()
+        else:  # nothing (or a single position) valid to span; the bins are empty or hold everything in one
+            lo = position.min() if len(position) else 0.
+            hi = lo + 1.
+        binindex = ((position - lo) * (bins / (hi - lo))).astype(np.int32)
+        np.clip(binindex, 0, bins - 1, out=binindex)
+        matrix = sparse.csr_matrix((np.ones(len(pixels), dtype=np.float32), (binindex, pixels)),
+                                   shape=(bins, int(np.prod(shape))))
+        centers = lo + (np.arange(bins) + .5) * (hi - lo) / bins
+        solidangle = AI.solidAngleArray(shape[::-1]).T.ravel().astype(np.float64)
+        nbytes = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + solidangle.nbytes
+        entry = _cacheput(key, (matrix, centers, solidangle), nbytes)
+    return entry
+
+
+def multiintegrate(data, mask, AIdict, cuts=(), colors=(), requestkey=None, axis='q', bins=None, alphai=None):
+    """
+    Integrate the full image and a stack of ROI cuts together. The full image is a single sparse matrix-vector product;
+    all ROI curves come from one product of the bin matrix with a combined sparse (pixels x ROIs) selection matrix.
+    Each bin is normalized as pyFAI does, sum(signal) / sum(solid angle), but pixels are not split between bins.
+
+    :param cuts: sequence of ROI masks (1-valid) with the same shape as data
+    :param colors: plot color per cut
+    :param alphai: incidence angle (radians) to bin by GIXS coordinates; see binmatrix
+    :return: list of (x, profile, color, requestkey); the full image curve is first
+    """
+    if bins is None:
+        bins = 2000 if axis == 'q' else 1000
+    if mask is None: mask = config.activeExperiment.mask
+    if mask is None or not mask.shape == data.shape:
+        msg.logMessage("No mask match. Mask will be ignored.", msg.WARNING)
         mask = np.ones_like(data)
-        msg.logMessage(('emptymask:', mask.shape),msg.DEBUG)
 
-    if cut is not None:
-        msg.logMessage(('cut:', cut.shape),msg.DEBUG)
-        mask &= cut.astype(bool)
+    matrix, centers, solidangle = binmatrix(AIdict, data.shape, mask, bins, axis, alphai)
+    signal = np.ravel(data).astype(np.float64)
+
+    norms = [matrix.dot(solidangle)]
+    sums = [matrix.dot(signal)]
+
+    if len(cuts):
+        pixels = [np.flatnonzero(cut) for cut in cuts]
+        columns = np.repeat(np.arange(len(pixels)), [len(p) for p in pixels])
+        pixels = np.concatenate(pixels)
+        ncuts = len(cuts)
+        # Left half of the selection accumulates solid angle, right half intensity
+        selection = sparse.csc_matrix((np.concatenate([solidangle[pixels], signal[pixels]]),
+                                       (np.tile(pixels, 2), np.concatenate([columns, columns + ncuts]))),
+                                      shape=(data.size, 2 * ncuts))
+        result = matrix.dot(selection).toarray()
+        norms.extend(result[:, :ncuts].T)
+        sums.extend(result[:, ncuts:].T)
+
+    results = []
+    for s, n, color in zip(sums, norms, [None] + list(colors)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profile = np.where(n > 0, s / n, 0)
+        results.append((centers, profile, color, requestkey))
+    return results
+
+
+def integraterois(integrationfunction, data, mask, AIdict, cuts=(), colors=(), requestkey=None, qvrt=None,
+                  qpar=None):
+    """
+    Integrate the full image and all ROI cuts as a single job. GIXS modes, and q and chi modes while the 'sparse'
+    backend is selected, are integrated in one pass; the rest, or a batch that fails, are integrated once per curve so
+    that one bad cut only drops its own curve.
 
-    center = np.where(np.abs(qvrt) == np.abs(qvrt).min())
-    qx = -qvrt[center[1][0]]/10.
+    :return: list of (x, profile, color, requestkey); the full image curve is first if it succeeded
+    """
+    batched = integrationfunction in batchedintegrations
+    if batched:
+        axis, isgixs = batchedintegrations[integrationfunction]
+        batched = isgixs or selectbackend(AIdict, data.T.shape) == 'sparse'
+    if batched:
+        alphai = gixsalphai() if isgixs else None
+        try:
+            return multiintegrate(data, mask, AIdict, cuts, colors, requestkey, axis=axis, alphai=alphai)
+        except Exception as ex:
+            msg.logMessage(('Batched integration failed; integrating each curve separately:', ex), msg.WARNING)
+
+        def integrate(cut, color):
+            return multiintegrate(data, mask, AIdict, [] if cut is None else [cut], [color], requestkey, axis=axis,
+                                  alphai=alphai)[-1]
+    else:
+        def integrate(cut, color):
+            return integrationfunction(data, mask.copy(), AIdict, cut, color, requestkey, qvrt, qpar)
 
-    maskeddata = np.ma.masked_array(data, mask=1 - mask)
-    xprofile = np.ma.average(maskeddata, axis=0)
+    results = []
+    for cut, color in [(None, None)] + zip(cuts, colors):
+        try:
+            results.append(integrate(cut, color))
+        except Exception as ex:
+            msg.logMessage(('Could not integrate', 'image' if cut is None else 'ROI', ex), msg.ERROR)
+    return results
 
-    return qx, xprofile, color, requestkey
+
+def gixsalphai():
+    return np.deg2rad(config.activeExperiment.getvalue('Incidence Angle (GIXS)'))
+
+
+def _gixsintegrate(axis, data, mask, AIdict, cut, color, requestkey):
+    cuts = [] if cut is None else [cut]
+    x, y, _, _ = multiintegrate(data, mask, AIdict, cuts, [color], requestkey, axis=axis, alphai=gixsalphai())[-1]
+    return x, y, color, requestkey
+
+
+def gixsqintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt=None, qpar=None):
+    """
+    |q| profile of an unremeshed GIXS image; detector pixels are binned straight into (q_par, q_z) space
+    """
+    return _gixsintegrate('q', data, mask, AIdict, cut, color, requestkey)
+
+
+def gixschiintegrate(data, mask, AIdict, cut=None, color=[255, 255, 255], requestkey=None, qvrt=None, qpar=None):
+    """
+    chi profile of an unremeshed GIXS image; detector pixels are binned straight into (q_par, q_z) space
+    """
+    return _gixsintegrate('chi', data, mask, AIdict, cut, color, requestkey)
+
+
+# integration functions which multiintegrate can replace, with their integration axis and whether it is a GIXS mode
+batchedintegrations = {qintegrate: ('q', False),
+                       radialintegratepyFAI: ('q', False),
+                       chiintegratepyFAI: ('chi', False),
+                       gixsqintegrate: ('q', True),
+                       gixschiintegrate: ('chi', True)}
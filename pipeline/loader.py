@@ -11,11 +11,17 @@ from pyFAI import detectors
 import pyFAI
 import glob
 import re
+import threading
+import time
+import hashlib
+import itertools
+import json
 import writer
 from xicam import debugtools, config
-from pipeline.formats import TiffStack
+from pipeline.formats import TiffStack, readedfheader, readtiffheader, memmapframes, openimage
 from PySide import QtGui
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 from pipeline import msg
 # try:
 #     import libtiff
@@ -50,9 +56,12 @@ def loadimage(path):
             #         else:
             #             return loadimage(str(nxroot.data.rawfile))
             # else:
-                data = fabio.open(path).data
+                frames = memmapframes(path)  # uncompressed formats are mapped rather than read
+                if frames is not None:
+                    return frames[0]
+                data = openimage(path).data
                 return data
-    except IOError:
+    except EnvironmentError:  # IOError, or OSError from the memory-mapped readers
         msg.logMessage('IO Error loading: ' + path,msg.ERROR)
     except TypeError:
         msg.logMessage('The selected file is not a type understood by fabIO.',msg.ERROR)
@@ -121,7 +130,7 @@ def loadparas(path):
             return head[0].header
 
         elif extension == '.edf':
-            return fabio.open(path).header
+            return readedfheader(path)
 
         elif extension == '.gb':
             return {}
@@ -131,7 +140,10 @@ def loadparas(path):
             # print nxroot.tree
             return nxroot
 
-        elif extension in ['.tif', '.img', '.tiff']:
+        elif extension in ['.tif', '.tiff']:
+            return readtiffheader(path)
+
+        elif extension == '.img':
             fimg = fabio.open(path)
             return fimg.header
 
@@ -142,6 +154,127 @@ def loadparas(path):
         msg.logMessage('No txt file found in loadparas',msg.WARNING)
     return OrderedDict()
 
+
+# Header index: per-directory JSON sidecar files of parsed headers, keyed by file name and validated by size and mtime.
+# Sidecars sit in shared data directories, so they are only ever read as data.
+headerindexname = '.xicamheaders.json'
+headerindexexts = ['.edf', '.fits', '.tif', '.tiff', '.img', '.gb']
+headerthreads = 8
+_headerindices = dict()
+_headerindexlock = threading.Lock()
+
+
+def _headerindexpaths(directory):
+    # The sidecar in the data directory, and a fallback in the user cache for read-only directories
+    return [os.path.join(directory, headerindexname),
+            os.path.join(pathtools.user_cache_dir, 'headers',
+                         hashlib.md5(directory.encode('utf-8')).hexdigest() + '.json')]
+
+
+def _jsonvalue(value):
+    # Header values json can't represent itself (numpy scalars, fits cards...)
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _loadheaderindex(directory):
+    with _headerindexlock:
+        if directory in _headerindices:
+            return _headerindices[directory]
+
+    index = dict()
+    for path in _headerindexpaths(directory):
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    loaded = json.load(f, object_pairs_hook=OrderedDict)
+                # Keep only well-formed [size, mtime, header] entries
+                index = dict((name, entry) for name, entry in loaded.items()
+                             if isinstance(entry, list) and len(entry) == 3 and isinstance(entry[2], dict))
+                break
+            except Exception as ex:
+                msg.logMessage(('Could not read header index', path, ex.message), msg.WARNING)
+
+    with _headerindexlock:
+        return _headerindices.setdefault(directory, index)
+
+
+def _saveheaderindex(directory, index):
+    for path in _headerindexpaths(directory):
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wb') as f:
+                with _headerindexlock:
+                    json.dump(index, f, default=_jsonvalue)
+            if os.path.exists(path) and os.name == 'nt':
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+            return
+        except (IOError, OSError, TypeError, ValueError):
+            continue
+    msg.logMessage('Could not save header index for ' + directory, msg.WARNING)
+
+
+def _readheader(path):
+    try:
+        header = loadparas(path)
+        return OrderedDict(header.items()) if hasattr(header, 'items') else header
+    except Exception as ex:
+        msg.logMessage(('Could not read header of', path, ex.message), msg.WARNING)
+        return OrderedDict()
+
+
+def loadheaders(paths, threads=None):
+    """
+    Headers of many files, from the directory sidecar indices where they are current and otherwise parsed in parallel
+    (headers only, without reading pixel data). New headers are added to the sidecars.
+
+    :param paths: list of file paths
+    :param threads: number of parser threads; defaults to headerthreads
+    :return: list of headers in the order of paths
+    """
+    headers = [None] * len(paths)
+    stale = []
+    for i, path in enumerate(paths):
+        path = os.path.abspath(path)
+        if os.path.splitext(path)[1] not in headerindexexts:
+            headers[i] = loadparas(path)
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            headers[i] = OrderedDict()
+            continue
+        directory, name = os.path.split(path)
+        entry = _loadheaderindex(directory).get(name)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            headers[i] = entry[2]
+        else:
+            stale.append((i, path, stat))
+
+    if stale:
+        pool = ThreadPool(min(threads or headerthreads, len(stale)))
+        try:
+            parsed = pool.map(_readheader, [path for _, path, _ in stale])
+        finally:
+            pool.close()
+
+        changed = set()
+        for (i, path, stat), header in zip(stale, parsed):
+            headers[i] = header
+            directory, name = os.path.split(path)
+            index = _loadheaderindex(directory)
+            with _headerindexlock:
+                index[name] = (stat.st_size, stat.st_mtime, header)
+            changed.add(directory)
+        for directory in changed:
+            _saveheaderindex(directory, _loadheaderindex(directory))
+
+    return headers
+
+
 def loadstitched(filepath2, filepath1, data1=None, data2=None, paras1=None, paras2=None):
     if data1 is None or data2 is None or paras1 is None or paras2 is None:
         (data1, paras1) = loadsingle(filepath1)
@@ -195,10 +328,10 @@ def loadstitched(filepath2, filepath1, data1=None, data2=None, paras1=None, para
     d2 = np.pad(data2, ((padtop2, padbottom2), (padleft2, padright2)), 'constant')
     d1 = np.pad(data1, ((padtop1, padbottom1), (padleft1, padright1)), 'constant')
 
-    mask2 = np.pad(1 - finddetectorbyfilename(filepath2, data2).calc_mask(),
+    mask2 = np.pad(1 - detectormask(finddetectorbyfilename(filepath2, data2)),
                       ((padtop2, padbottom2), (padleft2, padright2)),
                       'constant')
-    mask1 = np.pad(1 - finddetectorbyfilename(filepath1, data1).calc_mask(),
+    mask1 = np.pad(1 - detectormask(finddetectorbyfilename(filepath1, data1)),
                       ((padtop1, padbottom1), (padleft1, padright1)),
                       'constant')
 
@@ -246,12 +379,76 @@ def loadthumbnail(path):
 #     raise ValueError('Detector could not be identified!')
 #     return None, None, None
 
+# (rows, cols) -> (name, detector class, binning), built once from the pyFAI registry
+_detectorindex = None
+_detectormasks = dict()
+_detectorlock = threading.Lock()
+
+
+def detectorindex():
+    """
+    Index of every detector shape in pyFAI.detectors.ALL_DETECTORS, including binned shapes. Where several detectors
+    share a shape, the first in name order wins.
+    """
+    global _detectorindex
+    with _detectorlock:
+        if _detectorindex is None:
+            index = dict()
+            for name, detector in sorted(pyFAI.detectors.ALL_DETECTORS.iteritems()):
+                maxshape = getattr(detector, 'MAX_SHAPE', None)
+                if maxshape is None:
+                    continue
+                index.setdefault(tuple(maxshape), (name, detector, None))
+                for binning in getattr(detector, 'BINNED_PIXEL_SIZE', {}).keys():
+                    shape = tuple(int(n) for n in np.array(maxshape) / binning)
+                    index.setdefault(shape, (name, detector, binning))
+            _detectorindex = index
+        return _detectorindex
+
+
+def identifydetector(shape):
+    """
+    Detector matching an image shape in file (pyFAI) orientation, with its binning applied
+    :return: name, detector instance; (None, None) if no detector has this shape
+    """
+    entry = detectorindex().get(tuple(shape))
+    if entry is None:
+        return None, None
+
+    name, detector, binning = entry
+    detector = detector()
+    if binning is not None:
+        detector.set_binning(binning)
+        msg.logMessage('Detector found with binning: ' + name)
+    else:
+        msg.logMessage('Detector found: ' + name)
+    return name, detector
+
+
+def detectormask(detector):
+    """
+    detector.calc_mask(), memoised per (detector, binning). The returned array is shared; don't modify it in place.
+    """
+    key = (detector.__class__, tuple(getattr(detector, 'binning', ())))
+    with _detectorlock:
+        if key not in _detectormasks:
+            _detectormasks[key] = detector.calc_mask()
+        return _detectormasks[key]
+
+
 def finddetectorbyfilename(path, data=None):
     if data is None:
         data = loadimage(path)
 
-    dimg = diffimage(filepath=path, data=data)
-    return dimg.detector
+    name, detector = identifydetector(data.shape)
+    if detector is not None and config.activeExperiment is not None:
+        mask = detectormask(detector)
+        if mask is not None:
+            config.activeExperiment.addtomask(np.rot90(1 - mask, 3))  # FABIO uses 0-valid mask
+        config.activeExperiment.setvalue('Pixel Size X', detector.pixel1)
+        config.activeExperiment.setvalue('Pixel Size Y', detector.pixel2)
+        config.activeExperiment.setvalue('Detector', detector.name)
+    return detector
 
 
 # def loadthumbnail(path):
@@ -292,6 +489,17 @@ def convertto8bit(image):
     return image.astype(np.uint8)
 
 
+def logintensity(data):
+    """
+    Log-scaled image for display, log(data * (data > 0) + (data < 1)), computed in a single float32 buffer
+    """
+    out = np.array(data, dtype=np.float32)
+    np.maximum(out, 0, out=out)
+    np.add(out, 1, out=out, where=out < 1)
+    np.log(out, out=out)
+    return out
+
+
 def loadtiffstack(path):
     msg.logMessage(('Loading', path + '...'))
     data = np.swapaxes(libtiff.TIFF3D.open(path).read_image(), 0, 1)
@@ -307,7 +515,7 @@ def loadimageseries(pattern):
     files = glob.glob(pattern)
     data = np.dstack([fabio.open(f).data for f in files])
     msg.logMessage('Log scaling data...')
-    data = (np.log(data * (data > 0) + (data < 1)))
+    data = logintensity(data)
     msg.logMessage('Converting to 8-bit and re-scaling...')
     data = convertto8bit(data)
     msg.logMessage(('Load complete. Size:', np.shape(data)))
@@ -317,6 +525,242 @@ def loadimageseries(pattern):
 import integration, remesh, center_approx, variation, pathtools
 
 
+class lruframecache(object):
+    """
+    Process-wide LRU cache of frames, bounded by total bytes and shared by every open image so that several tabs
+    compete for one budget. Keys are (source, frame, transform).
+    """
+
+    def __init__(self, maxbytes=1024 * 2 ** 20):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, load=None):
+        """
+        Return the cached frame for key, marking it most recently used. On a miss, frame = load() is cached and
+        returned if a loader is given; otherwise None.
+        """
+        with self._lock:
+            if key in self._frames:
+                frame = self._frames.pop(key)
+                self._frames[key] = frame
+                self.hits += 1
+                return frame
+            self.misses += 1
+
+        if load is None:
+            return None
+        frame = load()
+        self.put(key, frame)
+        return frame
+
+    def peek(self, key):
+        """
+        The cached frame for key, or None, without marking it used or counting a hit or miss
+        """
+        with self._lock:
+            return self._frames.get(key)
+
+    def put(self, key, frame):
+        nbytes = getattr(frame, 'nbytes', 0)
+        with self._lock:
+            if key in self._frames:
+                self._nbytes -= getattr(self._frames.pop(key), 'nbytes', 0)
+            if nbytes > self.maxbytes:
+                return
+            self._frames[key] = frame
+            self._nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._frames and self._nbytes > self.maxbytes:
+            _, evicted = self._frames.popitem(last=False)
+            self._nbytes -= getattr(evicted, 'nbytes', 0)
+
+    def discard(self, source, raw=True):
+        """
+        Drop the cached frames of source, or of every version of the file if source is a path; with raw=False,
+        untransformed ('raw') frames are kept
+        """
+        def matches(key):
+            return key[0] == source or (isinstance(key[0], tuple) and key[0][:1] == (source,))
+
+        with self._lock:
+            for key in [key for key in self._frames if matches(key) and (raw or key[2] != 'raw')]:
+                self._nbytes -= getattr(self._frames.pop(key), 'nbytes', 0)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._nbytes = 0
+
+    def resize(self, maxbytes):
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'frames': len(self._frames), 'nbytes': self._nbytes,
+                    'maxbytes': self.maxbytes}
+
+
+framecache = lruframecache()
+
+
+# Worker pool shared by all read-ahead prefetchers
+prefetchworkers = 2
+_prefetchpool = None
+
+
+def _getprefetchpool():
+    global _prefetchpool
+    if _prefetchpool is None:
+        _prefetchpool = ThreadPool(prefetchworkers)
+    return _prefetchpool
+
+
+class readahead(object):
+    """
+    Background read-ahead of the frames of an image series into framecache. update() is called with each new
+    frame index; the next frames are predicted from the scroll direction and speed (frames expected within the next
+    `lookahead` seconds, at most `maxahead`) and read on a shared worker pool with at most `maxinflight` reads
+    outstanding. A change of direction cancels the reads that have not started yet.
+
+    The image must provide rawframe(i) and rawframekey(i).
+    """
+
+    def __init__(self, image, lookahead=.5, maxahead=16, maxinflight=4):
+        self.image = image
+        self.lookahead = lookahead
+        self.maxahead = maxahead
+        self.maxinflight = maxinflight
+
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._inflight = set()
+        self._generation = 0
+        self._direction = 0
+        self._last = None
+        self._lasttime = None
+
+    def update(self, frame):
+        now = time.time()
+        last, lasttime = self._last, self._lasttime
+        self._last, self._lasttime = frame, now
+        if last is None or frame == last:
+            return
+
+        step = frame - last
+        direction = 1 if step > 0 else -1
+        speed = abs(step) / max(now - lasttime, 1e-3)  # frames per second
+        count = int(min(max(np.ceil(speed * self.lookahead / abs(step)), 1), self.maxahead))
+        frames = [frame + step * k for k in range(1, count + 1) if 0 <= frame + step * k < len(self.image)]
+
+        with self._lock:
+            if direction != self._direction:
+                self._direction = direction
+                self._generation += 1  # queued reads of an older generation are dropped
+            self._pending = deque(frames)
+        self._fill()
+
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            self._direction = 0
+            self._last = None
+
+    def _fill(self):
+        # Only queue bookkeeping happens under the lock; frames already cached are skipped by the workers
+        while True:
+            with self._lock:
+                if not self._pending or len(self._inflight) >= self.maxinflight:
+                    return
+                i = self._pending.popleft()
+                if i in self._inflight:
+                    continue
+                self._inflight.add(i)
+                generation = self._generation
+            _getprefetchpool().apply_async(self._read, (i, generation))
+
+    def _read(self, i, generation):
+        try:
+            if generation == self._generation and self.image.rawframekey(i) not in framecache:
+                self.image.rawframe(i)
+        except Exception as ex:
+            msg.logMessage(('Read-ahead of frame', i, 'failed:', ex.message), msg.WARNING)
+        finally:
+            with self._lock:
+                self._inflight.discard(i)
+            self._fill()
+
+
+_frametokens = itertools.count()
+
+
+def filestamp(path):
+    """
+    (path, size, mtime) of a file, so that a file rewritten in place is a new frame cache source
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None
+    return path, stat.st_size, stat.st_mtime
+
+
+def _imagestamp(obj, path):
+    # Files are stamped once per image, so that frame lookups don't stat them (slow on network file systems)
+    stamps = getattr(obj, '_framestamps', None)
+    if stamps is None:
+        stamps = obj._framestamps = dict()
+    stamp = stamps.get(path)
+    if stamp is None:
+        stamp = stamps[path] = filestamp(path)
+    return stamp
+
+
+def refreshframesources(obj):
+    """
+    Stamp the files of an image again on their next lookup, so that files rewritten since are read anew
+    """
+    obj._framestamps = dict()
+
+
+def framesource(obj, path=None):
+    """
+    Frame cache source of an image object: the stamp of its file(s) when it has them, so that images of the same file
+    share cached frames, otherwise a token unique to the object for its lifetime. Stamps are taken on the first lookup
+    of each file and kept until refreshframesources.
+    """
+    if isinstance(path, list):
+        path = tuple(path) if len(path) > 1 else path[0]
+    if isinstance(path, tuple):
+        return tuple(_imagestamp(obj, p) for p in path)
+    if path:
+        return _imagestamp(obj, path)
+    token = getattr(obj, '_frametoken', None)
+    if token is None:
+        token = obj._frametoken = next(_frametokens)  # unlike id(), never reused by another object
+    return 'object', token
+
+
 class diffimage():
     def __init__(self, filepath=None, data=None, detector=None, experiment=None):
         """
@@ -417,7 +861,7 @@ class diffimage():
                 return self._detector
 
             self.detectorname = name
-            mask = detector.calc_mask()
+            mask = detectormask(detector)
             self._detector = detector
             if detector is not None:
                 if self.experiment is not None:
@@ -429,25 +873,7 @@ class diffimage():
         return self._detector
 
     def finddetector(self):
-        for name, detector in sorted(pyFAI.detectors.ALL_DETECTORS.iteritems()):
-            # print detector
-            # print 'det:',name, detector
-            if hasattr(detector, 'MAX_SHAPE'):
-                # print name, detector.MAX_SHAPE, imgdata.shape[::-1]
-                if detector.MAX_SHAPE == self.data.shape[::-1]:  #
-                    detector = detector()
-                    msg.logMessage('Detector found: ' + name)
-                    return name, detector
-            if hasattr(detector, 'BINNED_PIXEL_SIZE'):
-                # print detector.BINNED_PIXEL_SIZE.keys()
-                for binning in detector.BINNED_PIXEL_SIZE.keys():
-                    if self.data.shape[::-1] == tuple(np.array(detector.MAX_SHAPE) / binning):
-                        detector = detector()
-                        msg.logMessage('Detector found with binning: ' + name)
-                        detector.set_binning(binning)
-                        return name, detector
-        return None, None
-        raise ValueError('Detector could not be identified!')
+        return identifydetector(self.data.shape[::-1])
 
     @detector.setter
     def detector(self, value):
@@ -786,6 +1212,7 @@ class StackImage(object):
     """
 
     ndim = 3
+    frametransform = 'projection'
 
     def __init__(self, filepath=None, data=None):
         super(StackImage, self).__init__()
@@ -798,7 +1225,7 @@ class StackImage(object):
             if isinstance(filepath, list) or os.path.isdir(filepath):
                 self.fabimage = TiffStack(filepath)
             else:
-                self.fabimage = fabio.open(filepath)
+                self.fabimage = openimage(filepath)
         elif data is not None:
             self.fabimage = data
         else:
@@ -806,8 +1233,6 @@ class StackImage(object):
                 raise ValueError('Either data or path to file must be provided')
         self.header = self.fabimage.header
 
-        self._framecache = dict()
-        self._cachesize = 2
         self.currentframe = 0
 
         raw = self.rawdata
@@ -825,6 +1250,10 @@ class StackImage(object):
         return self._rawdata
 
     def asVolume(self, level=1):
+        volume = getattr(self.fabimage, 'volume', None)
+        if volume is not None and type(self)._getimage == StackImage._getimage:
+            return volume[::level, ::level, ::level]  # view of the memory-mapped stack
+
         for i, j in enumerate(range(0, self.shape[0], level)):
             img = self._getimage(j)[::level, ::level].transpose()
             if i == 0:  # allocate array:
@@ -838,24 +1267,26 @@ class StackImage(object):
         if type(frame) is list and type(frame[0]) is slice:
             frame = 0  # frame[1].step
         self.currentframe = frame
-        # print self._framecache
-        if frame not in self._framecache:
-            # del the first cached item
-            if len(self._framecache) > self._cachesize: del self._framecache[self._framecache.keys()[0]]
-            self._framecache[frame] = self._getimage(frame)
-        return self._framecache[frame]
+        return framecache.get((framesource(self, self.filepath), frame, self.frametransform),
+                              lambda: self._getimage(frame))
 
     def _getimage(self, frame):
-        return self.fabimage.getframe(frame).transpose()
+        img = self.fabimage.getframe(frame)
+        if isinstance(img, fabio.fabioimage.fabioimage):
+            img = img.data
+        return img.transpose()
 
     def invalidatecache(self):
         self.cache = dict()
+        refreshframesources(self)
 
     # This needs more thought to get some slices out of there
     def __getitem__(self, item):
         return self._getframe(item)
 
     def __del__(self):
+        if getattr(self, 'filepath', None) is None:
+            framecache.discard(framesource(self))  # nothing can ask for this object's frames again
         try:
             self.fabimage.close()
         except ValueError:
@@ -1021,7 +1452,7 @@ class diffimage2(object):
                 return self._detector
 
             self.detectorname = name
-            mask = detector.calc_mask()
+            mask = detectormask(detector)
             self._detector = detector
             if detector is not None:
                 if self.experiment is not None:
@@ -1033,22 +1464,7 @@ class diffimage2(object):
         return self._detector
 
     def finddetector(self):
-        for name, detector in sorted(pyFAI.detectors.ALL_DETECTORS.iteritems()):
-            if hasattr(detector, 'MAX_SHAPE'):
-                # print name, detector.MAX_SHAPE, self.rawdata.shape[::-1]
-                if detector.MAX_SHAPE == self.rawdata.shape[::-1]:  #
-                    detector = detector()
-                    msg.logMessage('Detector found: ' + name)
-                    return name, detector
-            if hasattr(detector, 'BINNED_PIXEL_SIZE'):
-                # print detector.BINNED_PIXEL_SIZE.keys()
-                for binning in detector.BINNED_PIXEL_SIZE.keys():
-                    if self.rawdata.shape[::-1] == tuple(np.array(detector.MAX_SHAPE) / binning):
-                        detector = detector()
-                        msg.logMessage('Detector found with binning: ' + name)
-                        detector.set_binning(binning)
-                        return name, detector
-        return None, None
+        return identifydetector(self.rawdata.shape[::-1])
 
     @detector.setter
     def detector(self, value):
@@ -1092,9 +1508,8 @@ class diffimage2(object):
     def cake(self, img, mask):
         self.cachedetector()
         if not self.iscached('cake'):
-            cake, x, y = integration.cake(img, self.experiment, mask=mask)
-            cakemask, _, _ = integration.cake(np.ones_like(img), self.experiment, mask=mask)
-            cakemask = cakemask > 0
+            cake, coverage, x, y = integration.cake2d(img, mask, self.experiment.getAI().getPyFAI())
+            cakemask = coverage > 0
 
             self.cache['cake'] = cake
             self.cache['cakemask'] = cakemask
@@ -1137,6 +1552,18 @@ class diffimage2(object):
 
         return self.cache['remesh']
 
+    def detectorcut(self, cut):
+        """
+        Map a cut drawn on the remeshed image back onto the detector pixels the remeshed image was sampled from
+        """
+        alphai = np.deg2rad(config.activeExperiment.getvalue('Incidence Angle (GIXS)'))
+        shape = self.rawdata.shape[::-1]  # remesh works on the image rotated back by 90 degrees
+        index, invalid, _, _ = remesh.remeshmap(shape, self.experiment.getAI(), alphai)
+        selected = np.rot90(cut, 1).astype(bool) & ~invalid
+        detector = np.zeros(shape, dtype=np.uint8)
+        detector.flat[index[selected]] = 1
+        return np.rot90(detector, 3)
+
     def findcenter(self):
         # Auto find the beam center
         [x, y] = center_approx.center_approx(self.rawdata)
@@ -1163,10 +1590,13 @@ class diffimage2(object):
 
     @property
     def displaydata(self):
-        # Not cached
-        if self.logscale:
-            return np.log(self.transformdata * (self.transformdata > 0) + (self.transformdata < 1))
-        return self.transformdata
+        # Cached per frame and display mode; invalidatecache() drops it when the geometry changes
+        key = (getattr(self, 'currentframe', 0), self.logscale, self.cakemode, self.remeshmode,
+               self.radialsymmetrymode, self.mirrorsymmetrymode)
+        if self.cache.get('displaykey') != key:
+            self.cache['display'] = logintensity(self.transformdata) if self.logscale else self.transformdata
+            self.cache['displaykey'] = key
+        return self.cache['display']
 
     def asarray(self):
         return self.displaydata
@@ -1310,7 +1740,6 @@ class multifilediffimage2(diffimage2):
         self.filepaths = sorted(list(filepaths))
         self._currentframe = 0
         super(multifilediffimage2, self).__init__(detector=detector, experiment=experiment)
-        self._framecache = dict()
         self._xvals = None
 
         self.dtype = self.rawdata.dtype
@@ -1332,18 +1761,18 @@ class multifilediffimage2(diffimage2):
     @property
     def headers(self):
         if self._headers is None:
-            self._headers = loadparas(self.filepaths[self.currentframe])
+            self._headers = self.iHeaders(self.currentframe)
 
         return self._headers
 
     def iHeaders(self, i):
-        return loadparas(self.filepaths[i])
+        return loadheaders([self.filepaths[i]])[0]
 
     def xvals(self, _):
         if self._xvals is None:
             timekey = config.activeExperiment.headermap['Timeline Axis']
             if timekey:
-                self._xvals = np.array([float(self.iHeaders(i)[timekey]) for i in range(len(self.filepaths))])
+                self._xvals = np.array([float(header[timekey]) for header in loadheaders(self.filepaths)])
             else:
                 self._xvals = np.arange(len(self.filepaths))
         return self._xvals
@@ -1359,9 +1788,37 @@ class multifilediffimage2(diffimage2):
     def rawdata(self):
         # 'Permanently' cached
         if self._rawdata is None:
-            self._rawdata = np.rot90(loadimage(self.filepaths[self.currentframe]), 3)
+            self._rawdata = self.rawframe(self.currentframe)
         return self._rawdata
 
+    def rawframe(self, i):
+        # Untransformed frame i, independent of currentframe; safe to call from worker threads
+        return framecache.get(self.rawframekey(i), lambda: np.rot90(loadimage(self.filepaths[i]), 3))
+
+    def rawframekey(self, i):
+        return framesource(self, self.filepaths[i]), 0, 'raw'
+
+    def scanframe(self, i):
+        # Untransformed frame i for passes over the whole series: read past the shared frame cache, only reusing frames
+        # already there, so as not to evict the viewer's frames
+        raw = framecache.peek(self.rawframekey(i))
+        if raw is None:
+            raw = np.rot90(loadimage(self.filepaths[i]), 3)
+        return raw
+
+    def variationframe(self, i):
+        # Frame i as the variation operators see it, without touching currentframe; raw frames only need the log
+        if self.cakemode or self.remeshmode:
+            return self._getframe(i)
+        raw = self.scanframe(i)
+        return logintensity(raw) if self.logscale else raw
+
+    def invalidatecache(self):
+        super(multifilediffimage2, self).invalidatecache()
+        for path in self.filepaths:
+            framecache.discard(path, raw=False)
+        refreshframesources(self)
+
     @property
     def transformdata(self):
         # 'Temporary' cached
@@ -1377,24 +1834,13 @@ class multifilediffimage2(diffimage2):
 
         return self.rawdata
 
-    @property
-    def displaydata(self):
-        # Not cached
-        # msg.logMessage(('applyinglog:', self.logscale),msg.DEBUG)
-        if self.logscale:
-            return np.log(self.transformdata * (self.transformdata > 0) + (self.transformdata < 1))
-        return self.transformdata
-
-    def _getframe(self, frame=None):  # keeps 3 frames in cache at most
+    def _getframe(self, frame=None):
         # print 'frame:',frame
         if frame is None: frame = self.currentframe
         if type(frame) is list: frame = frame[2].step
         self.currentframe = frame
-        if not frame in self._framecache:
-            if len(self._framecache) > 3: del self._framecache[
-                sorted(self._framecache.keys())[0]]  # del the first cached item
-            self._framecache[frame] = self.displaydata
-        return self._framecache[frame]
+        transform = ('display', self.logscale, self.cakemode, self.remeshmode)
+        return framecache.get((framesource(self, self.filepaths[frame]), 0, transform), lambda: self.displaydata)
 
     def calcVariation(self, i, operationindex, roi):
         if roi is None:
@@ -1435,9 +1881,9 @@ class stackdiffimage2(diffimage2):
         self.filepath = filepath
         super(stackdiffimage2, self).__init__(detector=detector, experiment=experiment)
 
-        self.fabimage = fabio.open(filepath)
+        self.fabimage = openimage(filepath)
+        self._readlock = threading.Lock()
 
-        self._framecache = dict()
         self.currentframe = 0
 
         raw = self.rawdata
@@ -1469,23 +1915,35 @@ class stackdiffimage2(diffimage2):
 
         return self.rawdata
 
-    @property
-    def displaydata(self):
-        # Not cached
-        if self.logscale:
-            return np.log(self.transformdata * (self.transformdata > 0) + (self.transformdata < 1))
-        return self.transformdata
-
-    def _getframe(self, frame=None):  # keeps 3 frames in cache at most
+    def _getframe(self, frame=None):
         if frame is None: frame = self.currentframe
         if type(frame) is list and type(frame[0]) is slice:
             frame = frame[1].step
-        frame = min(frame, len(self))
+        frame = min(frame, len(self) - 1)
         self.currentframe = frame
-        if frame not in self._framecache:
-            if len(self._framecache) > 2: del self._framecache[self._framecache.keys()[0]]  # del the first cached item
-            self._framecache[frame] = np.rot90(self.fabimage.getframe(frame).data, 3)
-        return self._framecache[frame]
+        return self.rawframe(frame)
+
+    def __len__(self):
+        return len(self.fabimage)
+
+    def rawframe(self, i):
+        # Untransformed frame i, independent of currentframe; safe to call from worker threads
+        return framecache.get(self.rawframekey(i), lambda: self._readframe(i))
+
+    def rawframekey(self, i):
+        return framesource(self, self.filepath), i, 'raw'
+
+    def scanframe(self, i):
+        # Untransformed frame i for passes over the whole stack, read past the shared frame cache (see
+        # multifilediffimage2.scanframe)
+        raw = framecache.peek(self.rawframekey(i))
+        if raw is None:
+            raw = self._readframe(i)
+        return raw
+
+    def _readframe(self, i):
+        with self._readlock:
+            return np.rot90(self.fabimage.getframe(i).data, 3)
 
     def __getitem__(self, item):
         return self._getframe(item)
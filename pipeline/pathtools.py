@@ -7,6 +7,7 @@ import msg
 from appdirs import *
 
 user_config_dir=user_config_dir('xicam')
+user_cache_dir=user_cache_dir('xicam')
 
 def similarframe(path, N):
     """
@@ -3,6 +3,8 @@
 # from image_load import *
 # import loader
 import numpy as np
+import threading
+from collections import OrderedDict
 from pyFAI import geometry
 
 from PySide import QtGui
@@ -11,9 +13,16 @@ import msg
 
 try:
     from cWarpImage import warp_image
+    import cWarpImage
 except ImportError:
+    cWarpImage = None
     msg.logMessage("Remeshing C extension is NOT LOADED!",msg.ERROR)
 
+# Interpolation methods of the C extension
+NEAREST = 0
+BILINEAR = 1
+CUBIC = 2
+
 
 def calc_q_range(lims, geometry, alphai, cen):
     nanometer = 1.0E+09
@@ -28,27 +37,44 @@ def calc_q_range(lims, geometry, alphai, cen):
     y, z = np.meshgrid(y, z)
     y -= cen[0]
     z -= cen[1]
+    k0 = 2. * np.pi / wavelen
+
+    # calculate q-values of each corner
+    qp, qz = gixsq(y, z, sdd, k0, alphai)
+    q_range = [qp.min(), qp.max(), qz.min(), qz.max()]
+    return q_range, k0
 
-    # calculate angles 
+
+def gixsq(y, z, sdd, k0, alphai):
+    """
+    (q_par, q_z) of detector positions y (horizontal) and z (vertical) relative to the direct beam, in the units of k0
+    """
+    # calculate angles
     tmp = np.sqrt(y ** 2 + sdd ** 2)
     cos2theta = sdd / tmp
     sin2theta = y / tmp
     tmp = np.sqrt(z ** 2 + y ** 2 + sdd ** 2)
     cosalpha = sdd / tmp
     sinalpha = z / tmp
-    k0 = 2. * np.pi / wavelen
 
-    # calculate q-values of each corner
     qx = k0 * (cosalpha * cos2theta - np.cos(alphai))
     qy = k0 * cosalpha * sin2theta
     qz = k0 * (sinalpha + np.sin(alphai))
     qp = np.sign(qy) * np.sqrt(qx ** 2 + qy ** 2)
-    q_range = [qp.min(), qp.max(), qz.min(), qz.max()]
-    return q_range, k0
+    return qp, qz
+
 
+# Cache of inverse remesh maps, keyed by (geometry, alphai, shape)
+remeshmapcachesize = 4
+_remeshmaps = OrderedDict()
+_remeshmaplock = threading.Lock()
 
-def remesh(image, filename, geometry, alphai):
-    shape = image.shape
+
+def remeshgrid(shape, geometry, alphai, gridded=True):
+    """
+    Uniformly spaced (qpar, qvrt) grids of the remeshed image along with the calibrated parameters used to build them.
+    With gridded=False only the parameters are computed and the grids are None.
+    """
     center = np.zeros(2, dtype=np.float)
     pixel = np.zeros(2, dtype=np.float)
 
@@ -60,86 +86,140 @@ def remesh(image, filename, geometry, alphai):
     center[0] = geometry.get_poni2() * nanometer
     center[1] = shape[0] * pixel[0] - geometry.get_poni1() * nanometer
 
+    if not gridded:
+        return None, None, pixel, center, 2. * np.pi / (geometry.get_wavelength() * nanometer), sdd
+
     # calculate q values
-    qrange, k0 = calc_q_range(image.shape, geometry, alphai, center)
+    qrange, k0 = calc_q_range(shape, geometry, alphai, center)
 
     # uniformly spaced q-values for remeshed image
-    nqz = image.shape[0]
+    nqz = shape[0]
     dqz = (qrange[3] - qrange[2]) / (nqz - 1)
     nqp = np.int((qrange[1] - qrange[0]) / dqz)
     qvrt = np.linspace(qrange[2], qrange[3], nqz)
     qpar = qrange[0] + np.arange(nqp) * dqz
     qpar, qvrt = np.meshgrid(qpar, qvrt)
 
-    try:
-        qimg = warp_image(image, qpar, qvrt, pixel, center, alphai, k0, sdd, 0)
-        return np.rot90(qimg, 3), np.rot90(qpar, 3), np.rot90(qvrt, 3)
-    except Exception:
+    return qpar, qvrt, pixel, center, k0, sdd
+
 
-        # find inverse map
-        cosi = np.cos(alphai)
-        sini = np.sin(alphai)
+def _mapkey(kind, shape, geometry, alphai):
+    return (kind, tuple(sorted((k, repr(v)) for k, v in geometry.getPyFAI().items())), geometry.get_wavelength(),
+            float(alphai), tuple(shape))
 
-        sina = (qvrt / k0) - sini
-        cosa2 = 1 - sina ** 2
-        cosa = np.sqrt(cosa2)
+
+def pixelqmap(shape, geometry, alphai):
+    """
+    (q_par, q_z) in nm^-1 of every detector pixel of an image with the given shape (in the orientation remesh takes),
+    without resampling the image. Cached per (geometry, alphai, shape).
+    """
+    key = _mapkey('pixelq', shape, geometry, alphai)
+    with _remeshmaplock:
+        if key in _remeshmaps:
+            entry = _remeshmaps.pop(key)
+            _remeshmaps[key] = entry
+            return entry
+
+    _, _, pixel, center, k0, sdd = remeshgrid(shape, geometry, alphai, gridded=False)
+    y = np.arange(shape[1], dtype=np.float) * pixel[0] - center[0]
+    z = np.arange(shape[0], dtype=np.float) * pixel[1] - center[1]
+    y, z = np.meshgrid(y, z)
+    entry = gixsq(y, z, sdd, k0, alphai)
+
+    with _remeshmaplock:
+        _remeshmaps[key] = entry
+        while len(_remeshmaps) > remeshmapcachesize:
+            _remeshmaps.popitem(last=False)
+    return entry
+
+
+def remeshmap(shape, geometry, alphai):
+    """
+    Inverse remesh map for an image shape: the flat (int32) index of the nearest source pixel for every (qp, qz) output
+    pixel, a mask of output pixels without a source, and the (qpar, qvrt) grids. Cached per (geometry, alphai, shape).
+    """
+    key = _mapkey('remesh', shape, geometry, alphai)
+    with _remeshmaplock:
+        if key in _remeshmaps:
+            entry = _remeshmaps.pop(key)
+            _remeshmaps[key] = entry
+            return entry
+
+    qpar, qvrt, pixel, center, k0, sdd = remeshgrid(shape, geometry, alphai)
+
+    # find inverse map, F : (qp,qz) --> (row,col)
+    cosi = np.cos(alphai)
+    sini = np.sin(alphai)
+
+    sina = (qvrt / k0) - sini
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosa = np.sqrt(np.clip(1 - sina ** 2, 0, None))
         tana = sina / cosa
 
-        t1 = cosa2 + cosi ** 2 - (qpar / k0) ** 2
+        t1 = cosa ** 2 + cosi ** 2 - (qpar / k0) ** 2
         t2 = 2. * cosa * cosi
         cost = t1 / t2
-        cost[t1 > t2] = 0
-        with np.errstate(divide='ignore'):
-            tant = np.sign(qpar) * np.sqrt(1. - cost ** 2) / cost
-            tant[cost == 0] = 0
-
-        # F : (qp,qz) --> (x,y)
-        map_x = (tant * sdd + center[0]) / pixel[0]
-        cost[cost < 0] = 1
-        with np.errstate(divide='ignore'):
-            map_y = (tana * sdd / cost + center[1]) / pixel[1]
-
-
-        # compute null space
-        nrow, ncol = image.shape
-        m1 = t1 > t2
-        m2 = np.logical_or(map_x < 0, map_x > ncol - 1)
-        m3 = np.logical_or(map_y < 0, map_y > nrow - 1)
-
-        mask = np.logical_or(np.logical_or(m1, m2), m3)
-        map_x[mask] = -1
-        map_y[mask] = -1
-
-        qsize = map_x.size
-        qshape = map_x.shape
-        qimg = np.fromiter((image[i, j] for i, j in np.nditer([map_y.astype(int),
-                                                               map_x.astype(int)])), dtype=np.float,
-                           count=qsize).reshape(qshape)
-        qimg[mask] = 0.
-        return np.rot90(qimg, 3), np.rot90(qpar, 3), np.rot90(qvrt, 3)
+        tant = np.sign(qpar) * np.sqrt(np.clip(1. - cost ** 2, 0, None)) / cost
 
-def remeshqarray(image, filename, geometry, alphai):
-    shape = image.shape
-    center = np.zeros(2, dtype=np.float)
-    pixel = np.zeros(2, dtype=np.float)
+        col = tant * sdd / pixel[0] + center[0] / pixel[0]
+        row = tana * sdd / cost / pixel[1] + center[1] / pixel[1]
 
-    # get calibrated parameters
-    nanometer = 1.0E+09
-    pixel[0] = geometry.get_pixel1() * nanometer
-    pixel[1] = geometry.get_pixel2() * nanometer
-    center[0] = geometry.get_poni2() * nanometer
-    center[1] = shape[0] * pixel[0] - geometry.get_poni1() * nanometer
+    # nearest neighbour, as the C extension
+    nrow, ncol = shape
+    invalid = (t1 > t2) | ~np.isfinite(row) | ~np.isfinite(col)
+    row[invalid] = -1
+    col[invalid] = -1
+    ir = np.floor(row + 0.5)
+    ic = np.floor(col + 0.5)
+    invalid |= (ic < 0) | (ic >= ncol) | (ir < 0) | (ir >= nrow)
 
-    # calculate q values
-    qrange, k0 = calc_q_range(image.shape, geometry, alphai, center)
+    index = (ir * ncol + ic).astype(np.int32)
+    index[invalid] = 0
 
-    # uniformly spaced q-values for remeshed image
-    nqz = image.shape[0]
-    dqz = (qrange[3] - qrange[2]) / (nqz - 1)
-    nqp = np.int((qrange[1] - qrange[0]) / dqz)
-    qvrt = np.linspace(qrange[2], qrange[3], nqz)
-    qpar = qrange[0] + np.arange(nqp) * dqz
-    qpar, qvrt = np.meshgrid(qpar, qvrt)
+    entry = (index, invalid, qpar, qvrt)
+    with _remeshmaplock:
+        _remeshmaps[key] = entry
+        while len(_remeshmaps) > remeshmapcachesize:
+            _remeshmaps.popitem(last=False)
+    return entry
+
+
+def setthreads(nthreads):
+    """
+    Set the number of OpenMP threads used by the C extension for interpolated remeshing
+    """
+    if cWarpImage is not None:
+        cWarpImage.set_num_threads(int(nthreads))
+
+
+def getthreads():
+    if cWarpImage is not None:
+        return cWarpImage.get_num_threads()
+    return 1
+
+
+def remesh(image, filename, geometry, alphai, method=NEAREST):
+    """
+    Remesh a GIXS image onto a uniform (qpar, qvrt) grid. Nearest neighbour uses the cached inverse map; BILINEAR and
+    CUBIC interpolate in the C extension.
+    """
+    if method != NEAREST:
+        if cWarpImage is None:
+            msg.logMessage('Interpolated remeshing needs the C extension; using nearest neighbour.', msg.WARNING)
+        else:
+            qpar, qvrt, pixel, center, k0, sdd = remeshgrid(image.shape, geometry, alphai)
+            qimg = warp_image(image, qpar, qvrt, pixel, center, alphai, k0, sdd, method)
+            return np.rot90(qimg, 3), np.rot90(qpar, 3), np.rot90(qvrt, 3)
+
+    index, invalid, qpar, qvrt = remeshmap(image.shape, geometry, alphai)
+
+    qimg = np.take(image, index).astype(np.float, copy=False)
+    qimg[invalid] = 0.
+    return np.rot90(qimg, 3), np.rot90(qpar, 3), np.rot90(qvrt, 3)
+
+
+def remeshqarray(image, filename, geometry, alphai):
+    qpar, qvrt, _, _, _, _ = remeshgrid(image.shape, geometry, alphai)
 
     return np.rot90(qpar, 3), np.rot90(qvrt, 3)
 
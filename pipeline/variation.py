@@ -1,19 +1,395 @@
+import os
+import sys
+import hashlib
+import itertools
+import json
 import numpy as np
+import multiprocessing
+import threading
+from collections import deque
 import loader
 import scipy.ndimage
 import warnings
 import variationoperators
+import pathtools
 import msg
+from xicam import config
 
 
-def variationiterator(simg,operationindex,roi=None,color=None):
+class framewindow(object):
+    """
+    Ring buffer of the prepared frames around the frame being evaluated, indexable like the image the operators
+    expect. Sliding it forward loads each frame once; the first frame stays pinned for the 'w/First Frame' operators.
+    """
+
+    def __init__(self, load, length, before=1, after=1):
+        self.load = load
+        self.length = length
+        self.before = before
+        self.after = after
+        self.frames = dict()
+        self.order = deque()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, t):
+        if not 0 <= t < self.length:
+            raise IndexError('frame index out of range: %d' % t)
+        if t not in self.frames:
+            self.frames[t] = self.load(t)
+            self.order.append(t)
+        return self.frames[t]
+
+    def advance(self, t):
+        # Drop frames behind the window, then load ahead of it
+        while self.order and self.order[0] < t - self.before:
+            index = self.order.popleft()
+            if index != 0:
+                del self.frames[index]
+        for index in xrange(max(t - self.before, 0), min(t + self.after + 1, self.length)):
+            self[index]
+
+
+def _framevariation(operation, window, t, rois):
+    # One value per ROI mask from the same prepared frames; None where the frame can't be evaluated
+    if t == 0:
+        return None  # Prevent wrap-around with first variation
+    window.advance(t)
+    try:
+        return [operation(window, t, 1 if roi is None else roi) for roi in rois]
+    except IndexError:
+        return None
+
+
+def _emitvariation(t, x, values, colors):
+    if values is None:
+        if t > 0: msg.logMessage(('Skipping index:', t), msg.WARNING)
+        values = [None] * len(colors)
+    for value, color in zip(values, colors):
+        yield (None if value is None else (x, value)), color
+
+
+def _streamvalues(simg, operationindex, rois, start=0, stop=None):
+    # (t, values) for each frame, values holding one entry per roi, or None
+    operation = variationoperators.operations.values()[operationindex]
+    if stop is None:
+        stop = len(simg)
+    window = framewindow(simg.variationframe, len(simg))
+    for t in xrange(start, stop):
+        yield t, _framevariation(operation, window, t, rois)
+
+
+def streamvariation(simg, operationindex, rois=(None,), colors=(None,), start=0, stop=None):
+    """
+    Variation of frames [start, stop) of simg within each ROI mask (None for the full frame), from a single pass
+    over the series; yields a ((x, value) or None, color) item per ROI at each frame
+    """
+    xvals = simg.xvals('')
+    for t, values in _streamvalues(simg, operationindex, rois, start, stop):
+        for result in _emitvariation(t, xvals[t], values, colors):
+            yield result
+
+
+# Worker processes for long timelines (see parallelvariationenabled); each evaluates a chunk of frames read in the
+# worker. Off by default: the pool is forked from the running application.
+parallelvariationdefault = False
+variationprocesses = min(multiprocessing.cpu_count(), 4)
+variationchunk = 256
+# Operators that only need the frames, and so can run away from the experiment and the GUI state
+processoperations = ('Chi Squared', 'Absolute Diff.', 'Norm. Abs. Diff.', 'Sum Intensity', 'Norm. Abs. Derivative',
+                     'Chi Squared w/First Frame')
+_variationpool = None
+_variationpoollock = threading.Lock()
+_cancelledscans = None  # ring of abandoned scan ids, shared with the workers
+_cancelledlock = threading.Lock()
+_scanids = itertools.count(1)
+
+
+def _initworker(cancelledscans):
+    global _cancelledscans
+    _cancelledscans = cancelledscans
+
+
+def parallelvariationenabled():
+    """
+    Whether long timelines are evaluated on worker processes, as set in the preferences. Python 2 can only fork them
+    from the running application, whose Qt and loader threads may hold locks at that moment, so this is opt-in and
+    never available on Windows (workers re-run the launcher) or macOS (forking after Qt loads is unsafe).
+    """
+    if sys.platform in ('win32', 'darwin') or variationprocesses < 2:
+        return False
+    enabled = config.settings['parallelvariation']
+    return parallelvariationdefault if enabled is None else bool(enabled)
+
+
+def setparallelvariation(enabled):
+    config.settings['parallelvariation'] = bool(enabled)
+
+
+def _getvariationpool():
+    # Forked on the first long timeline scan once enabled, then reused
+    global _variationpool, _cancelledscans
+    with _variationpoollock:
+        if _variationpool is None:
+            _cancelledscans = multiprocessing.Array('l', 64)
+            _variationpool = multiprocessing.Pool(variationprocesses, initializer=_initworker,
+                                                  initargs=(_cancelledscans,))
+        return _variationpool
+
+
+def _cancelscan(scanid):
+    with _cancelledlock:
+        _cancelledscans[scanid % len(_cancelledscans)] = scanid
+
+
+def _iscancelled(scanid):
+    return _cancelledscans is not None and scanid in _cancelledscans[:]
+
+
+def canparallelize(simg, operationindex, start=0):
+    return (parallelvariationenabled() and hasattr(simg, 'filepaths') and hasattr(simg, 'variationframe')
+            and not simg.cakemode and not simg.remeshmode
+            and variationoperators.operations.keys()[operationindex] in processoperations
+            and len(simg) - start >= 2 * variationchunk)
+
+
+def _chunkvariation(scanid, filepaths, start, stop, operationindex, rois, logscale):
+    # Runs in a worker process; the window reads one frame either side of the chunk, overlapping its neighbours.
+    # Chunks of an abandoned scan return None without (or without further) reading
+    operation = variationoperators.operations.values()[operationindex]
+
+    def load(t):
+        frame = np.rot90(loader.loadimage(filepaths[t]), 3)
+        return loader.logintensity(frame) if logscale else frame
+
+    window = framewindow(load, len(filepaths))
+    values = []
+    for t in xrange(start, stop):
+        if _iscancelled(scanid):
+            return None
+        values.append(_framevariation(operation, window, t, rois))
+    return values
+
+
+def _parallelvalues(simg, operationindex, rois, start=0, chunksize=None):
+    # (t, values) for each frame like _streamvalues, evaluated in chunks on the pool; closing it cancels the rest
+    chunksize = chunksize or variationchunk
+    scanid = next(_scanids)
+    pool = _getvariationpool()
+    jobs = [pool.apply_async(_chunkvariation, (scanid, simg.filepaths, first, min(first + chunksize, len(simg)),
+                                               operationindex, list(rois), simg.logscale))
+            for first in xrange(start, len(simg), chunksize)]
+
+    finished = False
+    try:
+        t = start
+        for job in jobs:
+            for values in job.get():
+                yield t, values
+                t += 1
+        finished = True
+    finally:
+        if not finished:
+            _cancelscan(scanid)
+
+
+def parallelvariation(simg, operationindex, rois=(None,), colors=(None,), start=0, chunksize=None):
+    """
+    Variation of frames [start, end) of a multi-file series evaluated in chunks on the process pool; yields the same
+    items as streamvariation, in frame order, as each chunk completes. Closing the generator early cancels the chunks
+    still queued or running.
+    """
+    xvals = simg.xvals('')
+    for t, values in _parallelvalues(simg, operationindex, rois, start, chunksize):
+        for result in _emitvariation(t, xvals[t], values, colors):
+            yield result
+
+
+# Per-frame variation values persisted across sessions, one file per curve under variationcachedir; the least recently
+# used files are removed once the directory holds more than variationcachebytes
+variationcaching = True
+variationcachedir = os.path.join(pathtools.user_cache_dir, 'variation')
+variationcachebytes = 64 * 2 ** 20
+
+
+def roidigest(roi):
+    if roi is None:
+        return 'full'
+    roi = np.ascontiguousarray(roi, dtype=float)  # ROIs weight the operators, so the values themselves are hashed
+    return hashlib.md5(roi).hexdigest() + str(roi.shape)
+
+
+def transformmode(simg):
+    """
+    The display transform the operators see, as part of a variation cache key; cake and remesh depend on the geometry
+    """
+    mode = (simg.logscale, simg.cakemode, simg.remeshmode)
+    if simg.cakemode or simg.remeshmode:
+        mode += (repr(sorted(simg.experiment.getAI().getPyFAI().items())), repr(simg.getAlphaI()))
+    return mode
+
+
+def _filestamps(paths):
+    stamps = []
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append((os.path.abspath(path), stat.st_size, stat.st_mtime))
+    return stamps
+
+
+def _variationcachepath(simg, operationindex, roi):
+    key = (os.path.abspath(simg.filepaths[0]), variationoperators.operations.keys()[operationindex], roidigest(roi),
+           transformmode(simg))
+    return os.path.join(variationcachedir, hashlib.md5(repr(key)).hexdigest() + '.json')
+
+
+def loadvariationcache(path, stamps):
+    """
+    Cached values of the leading frames whose files (path, size, mtime) are unchanged; frames appended since are
+    simply missing from the end
+    """
+    if not os.path.isfile(path):
+        return []
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+        cachedstamps = [tuple(stamp) for stamp in cache['stamps']]
+        values = [None if value is None else float(value) for value in cache['values']]
+    except (IOError, ValueError, TypeError, KeyError) as ex:
+        msg.logMessage(('Could not read variation cache', path, str(ex)), msg.WARNING)
+        return []
+    try:
+        os.utime(path, None)  # recently used, as far as pruning is concerned
+    except OSError:
+        pass
+
+    valid = 0
+    for cached, current in zip(cachedstamps, stamps):
+        if cached != current:
+            break
+        valid += 1
+    return values[:valid]
+
+
+def savevariationcache(path, stamps, values):
+    """
+    Store the values of a curve as JSON; curves of operators that don't give a single number per frame aren't cached
+    """
+    try:
+        values = [None if value is None else float(value) for value in values]
+    except (TypeError, ValueError):
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'stamps': stamps, 'values': values}, f)
+        if os.path.exists(path) and os.name == 'nt':
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError, ValueError) as ex:
+        msg.logMessage(('Could not save variation cache', path, str(ex)), msg.WARNING)
+        return
+    prunevariationcache(os.path.dirname(path))
+
+
+def prunevariationcache(directory=None, maxbytes=None):
+    """
+    Remove the least recently used cache files of directory (variationcachedir by default) until the rest fit in
+    maxbytes (variationcachebytes by default)
+    """
+    directory = directory or variationcachedir
+    if maxbytes is None:
+        maxbytes = variationcachebytes
+    if not os.path.isdir(directory):
+        return
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed meanwhile
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= maxbytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as ex:
+            msg.logMessage(('Could not prune variation cache', path, str(ex)), msg.WARNING)
+
+
+def _computevalues(simg, operationindex, rois, start=0):
+    if canparallelize(simg, operationindex, start):
+        return _parallelvalues(simg, operationindex, rois, start)
+    return _streamvalues(simg, operationindex, rois, start)
+
+
+def _computevariation(simg, operationindex, rois, colors, start=0):
+    if canparallelize(simg, operationindex, start):
+        return parallelvariation(simg, operationindex, rois, colors, start)
+    return streamvariation(simg, operationindex, rois, colors, start)
+
+
+def cachedvariation(simg, operationindex, rois, colors):
+    """
+    Variation of a multi-file series through the persistent cache: unchanged leading frames are replayed from disk,
+    only the rest (e.g. frames appended since) are evaluated, and the cache is extended once the scan completes
+    """
+    stamps = _filestamps(simg.filepaths)
+    cachepaths = [_variationcachepath(simg, operationindex, roi) for roi in rois]
+    curves = [loadvariationcache(path, stamps) for path in cachepaths]
+    # The last cached frame may have been evaluated without its successor, so it is always recomputed
+    start = max(min(len(values) for values in curves) - 1, 0)
+
+    xvals = simg.xvals('')
+    for t in xrange(start):
+        for result in _emitvariation(t, xvals[t], [values[t] for values in curves], colors):
+            yield result
+
+    curves = [values[:start] for values in curves]
+    for t, values in _computevalues(simg, operationindex, rois, start):
+        for k, curve in enumerate(curves):
+            curve.append(None if values is None else values[k])
+        for result in _emitvariation(t, xvals[t], values, colors):
+            yield result
+
+    for path, values in zip(cachepaths, curves):
+        savevariationcache(path, stamps, values)
+
+
+def variationiterator(simg,operationindex,roi=None,color=None,rois=None,colors=None):
+    """
+    Variation over the series for roi, or for each mask of rois (None for the full frame) with the matching color of
+    colors from one traversal
+    """
+    if rois is None:
+        rois, colors = [roi], [color]
+    elif colors is None:
+        colors = [None] * len(rois)
+
+    if hasattr(simg, 'variationframe'):
+        if variationcaching and hasattr(simg, 'filepaths'):
+            iterator = cachedvariation(simg, operationindex, rois, colors)
+        else:
+            iterator = _computevariation(simg, operationindex, rois, colors)
+        for result in iterator:
+            yield result
+        return
+
     for i in range(len(simg)):
-        yield simg.calcVariation(i, operationindex, roi), color
+        for roi, color in zip(rois, colors):
+            yield simg.calcVariation(i, operationindex, roi), color
 
 def scanvariation(filepaths):
     simg = loader.multifilediffimage2(filepaths)
-    for t in range(len(simg)):
-        variationoperators.chisquared(simg,t,None)
+    for _ in streamvariation(simg, variationoperators.operations.keys().index('Chi Squared')):
+        pass
 
 def filevariation(operationindex, filea, c, filec, roi=None):
     p = loader.loadimage(filea)
@@ -16,6 +16,7 @@ except ImportError:
     exit(1)
 
 from setuptools import setup, find_packages
+import sys
 from codecs import open
 from os import path
 import glob
@@ -27,10 +28,13 @@ here = path.abspath(path.dirname(__file__))
 with open(path.join(here, 'README.rst'), encoding='utf-8') as f:  # rst?
     long_description = f.read()
 
+# OpenMP parallelizes the remesh loop; Apple's clang does not ship it, so it's only enabled for gcc builds
+openmpargs = ['-fopenmp'] if sys.platform.startswith('linux') else []
+
 EXT = Extension(name='pipeline.cWarpImage',
                 sources=['cext/cWarpImage.cc', 'cext/remesh.cc'],
-                extra_compile_args=['-O3', '-ffast-math'],  # '-fopenmp',, '-I/opt/local/include'
-                # extra_link_args=['-fopenmp'],
+                extra_compile_args=['-O3', '-ffast-math'] + openmpargs,  # '-I/opt/local/include'
+                extra_link_args=openmpargs,
                 include_dirs=[np.get_include()],
                 )
 setup(
@@ -92,7 +96,7 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['scipy', 'Cython', 'pyFAI', 'fabio', 'h5py', 'Shiboken', 'PySide', 'pyqtgraph', 'QDarkStyle',
-                      'nexusformat', 'Pillow', 'pyfits', 'PyOpenGL', 'PyYAML', 'qtconsole','tifffile','pysftp','requests','dask','distributed','appdirs','futures','scikit-image','imageio','vispy'],
+                      'nexusformat', 'Pillow', 'pyfits', 'PyOpenGL', 'PyYAML', 'qtconsole','tifffile>=2018.10.18,<2020','pysftp','requests','dask','distributed','appdirs','futures','scikit-image','imageio','vispy'],
 
     setup_requires=['numpy', 'cython'],
 
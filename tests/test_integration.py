@@ -0,0 +1,102 @@
+import numpy as np
+import pyFAI
+
+from pipeline import integration
+
+shape = (40, 50)  # xicam orientation; pyFAI sees the transposed image
+
+
+def stubgeometry():
+    # A small detector with the beam near its middle
+    AI = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=2.5e-3, poni2=2e-3, pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    return AI.getPyFAI()
+
+
+def solidangle(AIdict):
+    return integration.getintegrator(AIdict, shape[::-1]).solidAngleArray(shape[::-1]).T
+
+
+def test_estimateintegratorbytes_without_bins():
+    assert integration._estimateintegratorbytes(shape, None) == 40 * 50 * 48
+
+
+def test_multiintegrate_full_image_and_rois():
+    integration.clearintegratorcache()
+    AIdict = stubgeometry()
+    # Intensity proportional to solid angle integrates to a flat profile
+    data = 7 * solidangle(AIdict)
+    mask = np.ones(shape, dtype=np.int)
+    cut = np.zeros(shape, dtype=np.int)
+    cut[:20] = 1
+
+    results = integration.multiintegrate(data, mask, AIdict, [cut], [[0, 255, 255]], requestkey=3, axis='q', bins=100)
+
+    assert len(results) == 2
+    for (x, profile, color, requestkey), expectedcolor in zip(results, [None, [0, 255, 255]]):
+        assert len(x) == len(profile) == 100
+        assert color == expectedcolor
+        assert requestkey == 3
+        filled = profile > 0
+        assert filled.any()
+        assert np.allclose(profile[filled], 7)
+
+
+def test_multiintegrate_all_masked():
+    integration.clearintegratorcache()
+    AIdict = stubgeometry()
+    data = np.ones(shape, dtype=np.uint16)
+    mask = np.zeros(shape, dtype=np.int)
+
+    for axis in ['q', 'chi']:
+        (x, profile, _, _), = integration.multiintegrate(data, mask, AIdict, axis=axis, bins=50)
+        assert len(profile) == 50
+        assert not profile.any()
+
+
+def test_integraterois_keeps_curves_of_valid_rois():
+    integration.clearintegratorcache()
+    AIdict = stubgeometry()
+    data = np.ones(shape, dtype=np.uint16)
+    mask = np.ones(shape, dtype=np.int)
+    good = np.zeros(shape, dtype=np.int)
+    good[10:30, 10:30] = 1
+    bad = np.ones((80, 80), dtype=np.int)  # indexes past the image
+
+    for name in ['sparse', 'csr']:
+        integration.setbackend(name)
+        try:
+            results = integration.integraterois(integration.radialintegratepyFAI, data, mask, AIdict, [bad, good],
+                                                [[255, 0, 0], [0, 255, 255]], requestkey=1)
+        finally:
+            integration.setbackend(None)
+
+        assert [color for _, _, color, _ in results] == [None, [0, 255, 255]]
+
+
+def test_benchmark_includes_batched_backend():
+    integration.clearintegratorcache()
+    timings = integration.benchmarkbackends(stubgeometry(), shape[::-1], npt=100, repeats=1)
+
+    assert 'sparse' in timings
+    assert 'csr' in timings
+
+
+def test_lineprofile_does_not_wrap_integer_frames():
+    data = np.full((2, 4000), 60000, dtype=np.uint16)
+    mask = np.ones(data.shape, dtype=np.int)
+
+    assert np.allclose(integration.lineprofile(data, mask, axis=1), 60000)
+    assert np.allclose(integration.lineprofile(data, mask, axis=0), 60000)
+
+
+def test_line_cuts_have_q_axis():
+    integration.clearintegratorcache()
+    AIdict = stubgeometry()
+    data = np.ones(shape, dtype=np.uint16)
+    mask = np.ones(shape, dtype=np.int)
+
+    qx, xprofile, _, _ = integration.xintegrate(data, mask, AIdict)
+    qz, zprofile, _, _ = integration.zintegrate(data, mask, AIdict)
+
+    assert len(qx) == len(xprofile) == shape[0]
+    assert len(qz) == len(zprofile) == shape[1]
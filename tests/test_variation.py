@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from pipeline import variation, variationoperators
+
+sumintensity = variationoperators.operations.keys().index('Sum Intensity')
+
+
+class stubseries(object):
+    # A multi-file series of small frames, recording which frames the operators read
+    cakemode = False
+    remeshmode = False
+    logscale = False
+
+    def __init__(self, filepaths):
+        self.filepaths = filepaths
+        self.reads = []
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def xvals(self, _):
+        return np.arange(len(self), dtype=np.float)
+
+    def variationframe(self, i):
+        self.reads.append(i)
+        return np.full((4, 4), i + 1, dtype=np.float)
+
+
+def makeseries(directory, n):
+    paths = []
+    for i in range(n):
+        path = str(directory.join('frame%03d.edf' % i))
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write('frame %d' % i)
+        paths.append(path)
+    return stubseries(paths)
+
+
+def scan(simg):
+    return list(variation.cachedvariation(simg, sumintensity, [None], [None]))
+
+
+def uncached(simg):
+    return list(variation.streamvariation(simg, sumintensity, [None], [None]))
+
+
+def test_cached_values_are_replayed(tmpdir, monkeypatch):
+    monkeypatch.setattr(variation, 'variationcachedir', str(tmpdir.mkdir('cache')))
+    data = tmpdir.mkdir('data')
+
+    first = scan(makeseries(data, 5))
+    simg = makeseries(data, 5)
+    second = scan(simg)
+
+    assert second == first == uncached(makeseries(data, 5))
+    assert set(simg.reads) <= {3, 4}  # only the last cached frame is evaluated again
+
+
+def test_appended_frames_extend_the_cache(tmpdir, monkeypatch):
+    cache = tmpdir.mkdir('cache')
+    monkeypatch.setattr(variation, 'variationcachedir', str(cache))
+    data = tmpdir.mkdir('data')
+
+    scan(makeseries(data, 5))
+    simg = makeseries(data, 8)
+    results = scan(simg)
+
+    assert results == uncached(makeseries(data, 8))
+    assert min(simg.reads) >= 3
+    path = variation._variationcachepath(simg, sumintensity, None)
+    assert len(variation.loadvariationcache(path, variation._filestamps(simg.filepaths))) == 8
+
+
+def test_changed_frames_are_recomputed(tmpdir, monkeypatch):
+    monkeypatch.setattr(variation, 'variationcachedir', str(tmpdir.mkdir('cache')))
+    data = tmpdir.mkdir('data')
+
+    scan(makeseries(data, 5))
+    with open(str(data.join('frame002.edf')), 'w') as f:
+        f.write('rewritten frame')
+    simg = makeseries(data, 5)
+    path = variation._variationcachepath(simg, sumintensity, None)
+
+    assert len(variation.loadvariationcache(path, variation._filestamps(simg.filepaths))) == 2
+    assert scan(simg) == uncached(makeseries(data, 5))
+
+
+def test_prune_removes_least_recently_used(tmpdir):
+    for i, name in enumerate(['old', 'middle', 'new']):
+        path = tmpdir.join(name + '.json')
+        path.write('x' * 100)
+        os.utime(str(path), (1000 + i, 1000 + i))
+
+    variation.prunevariationcache(str(tmpdir), maxbytes=250)
+
+    assert sorted(os.listdir(str(tmpdir))) == ['middle.json', 'new.json']
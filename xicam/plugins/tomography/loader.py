@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
+import os
+import hashlib
 from copy import copy
+from multiprocessing.pool import ThreadPool
+import h5py
+import numpy as np
 from pipeline.loader import StackImage
+from pipeline.formats import stackselection
+from pipeline import msg, pathtools
+from xicam.config import settings
 
 __author__ = "Luis Barroso-Luque"
 __copyright__ = "Copyright 2016, CAMERA, LBL, ALS"
@@ -12,6 +20,120 @@ __email__ = "ronpandolfi@lbl.gov"
 __status__ = "Beta"
 
 
+# Build a sinogram-major copy of projection stacks for sinogram access (see buildsinogramcache). The copy is as large
+# as the dataset, so it is only built when turned on in the preferences; this is the default otherwise.
+sinogramcaching = False
+sinogramcachesuffix = '.sino.h5'
+
+
+def sinogramcachingenabled():
+    enabled = settings['sinogramcaching']
+    return sinogramcaching if enabled is None else bool(enabled)
+
+
+def setsinogramcaching(enabled):
+    settings['sinogramcaching'] = bool(enabled)
+
+
+def sinogramcachepaths(path):
+    """
+    Candidate locations of the sinogram cache of a dataset: next to the data, and in the user cache directory for
+    read-only data directories
+    """
+    path = os.path.abspath(path)
+    name = os.path.splitext(os.path.basename(path))[0] + sinogramcachesuffix
+    return [os.path.join(os.path.dirname(path), name),
+            os.path.join(pathtools.user_cache_dir, 'sinograms', hashlib.md5(path.encode('utf-8')).hexdigest() + name)]
+
+
+def opensinogramcache(path):
+    """
+    Open the sinogram cache of a dataset if there is one that is up to date with the data
+
+    Returns
+    -------
+    h5py.Dataset or None
+        (rows, projections, columns) dataset
+    """
+    stat = os.stat(path)
+    for cachepath in sinogramcachepaths(path):
+        if not os.path.isfile(cachepath):
+            continue
+        try:
+            sinograms = h5py.File(cachepath, 'r')['sinograms']
+        except (IOError, KeyError):
+            continue
+        if sinograms.attrs.get('source_size') == stat.st_size and sinograms.attrs.get('source_mtime') == stat.st_mtime:
+            return sinograms
+        sinograms.file.close()
+    return None
+
+
+def buildsinogramcache(fabimage, path, blockrows=16, threads=2):
+    """
+    Transpose a projection stack into a sinogram-major HDF5 cache, out of core: blocks of detector rows are read from
+    all projections by a pool of reader threads, a few blocks at a time, and written as contiguous sinograms. The cache
+    is written to a temporary file and only renamed into place once complete.
+
+    Parameters
+    ----------
+    fabimage : fabioimage
+        Projection stack supporting readstack (eg. ALS832H5image)
+    path : str
+        Path of the dataset
+    blockrows : int
+        Detector rows per block
+    threads : int
+        Number of reader threads, which is also the number of blocks held in memory
+
+    Returns
+    -------
+    h5py.Dataset
+        The opened cache (see opensinogramcache)
+    """
+    nproj = len(fabimage)
+    nrows, ncols = fabimage.data.shape
+    blocks = [(r0, min(r0 + blockrows, nrows)) for r0 in range(0, nrows, blockrows)]
+    stat = os.stat(path)
+
+    def readblock(block):
+        return block, fabimage.readstack((slice(None), slice(*block), slice(None)))
+
+    for cachepath in sinogramcachepaths(path):
+        try:
+            if not os.path.isdir(os.path.dirname(cachepath)):
+                os.makedirs(os.path.dirname(cachepath))
+            h5 = h5py.File(cachepath + '.tmp', 'w')
+        except (IOError, OSError):
+            continue
+
+        msg.logMessage('Building sinogram cache ' + cachepath)
+        pool = ThreadPool(threads)
+        try:
+            sinograms = h5.create_dataset('sinograms', shape=(nrows, nproj, ncols), dtype=fabimage.data.dtype,
+                                          chunks=(1, nproj, ncols))
+            for i in range(0, len(blocks), threads):
+                for (r0, r1), data in pool.map(readblock, blocks[i:i + threads]):
+                    sinograms[r0:r1] = data.transpose(1, 0, 2)
+            sinograms.attrs['source_size'] = stat.st_size
+            sinograms.attrs['source_mtime'] = stat.st_mtime
+        except Exception:
+            h5.close()
+            os.remove(cachepath + '.tmp')
+            raise
+        finally:
+            pool.close()
+        h5.close()
+
+        if os.path.exists(cachepath):
+            os.remove(cachepath)
+        os.rename(cachepath + '.tmp', cachepath)
+        return opensinogramcache(path)
+
+    msg.logMessage('No writable location for the sinogram cache of ' + path, msg.WARNING)
+    return None
+
+
 class ProjectionStack(StackImage):
     """
     Simply subclass of StackImage for Tomography Projection stacks.
@@ -22,12 +144,43 @@ class ProjectionStack(StackImage):
         Flat field data
     darks : ndarray
         Dark field data
+    sinograms : h5py.Dataset
+        Sinogram-major (rows, projections, columns) cache of the raw data, or None
     """
 
     def __init__(self, filepath=None, data=None):
         super(ProjectionStack, self).__init__(filepath=filepath, data=data)
         self.flats = self.fabimage.flats
         self.darks = self.fabimage.darks
+        self.sinograms = None
+        if isinstance(filepath, basestring) and os.path.isfile(filepath):
+            self.sinograms = opensinogramcache(filepath)
+
+    def cachesinograms(self):
+        """
+        Build the sinogram cache of this stack if there isn't one (slow; meant for a background thread)
+        """
+        if self.sinograms is None and hasattr(self.fabimage, 'readstack'):
+            self.sinograms = buildsinogramcache(self.fabimage, self.filepath)
+        return self.sinograms
+
+    def readstack(self, slc):
+        """
+        Selection of the raw (projections, rows, columns) stack, as fabimage[slc], read from the sinogram cache when
+        there is one
+
+        Parameters
+        ----------
+        slc : tuple of slices/ints
+            Selection along the projection, row and column axes
+        """
+        if self.sinograms is None:
+            return self.fabimage[slc]
+        s = stackselection(slc, (len(self.fabimage),) + self.fabimage.data.shape)
+        if any(axis[2] < 0 for axis in s):  # hdf5 selections can't step backwards
+            return self.fabimage[slc]
+        data = self.sinograms[slice(*s[1]), slice(*s[0]), slice(*s[2])]
+        return np.squeeze(data.transpose(1, 0, 2))
 
 
 
@@ -37,9 +190,10 @@ class SinogramStack(StackImage):
     Simply subclass of StackImage for Tomography Sinogram stacks.
     """
 
+    frametransform = 'sinogram'
+
     def __init__(self, filepath=None, data=None):
         super(SinogramStack, self).__init__(filepath=filepath, data=data)
-        self._cachesize = 10
 
     def __new__(cls):
         cls.invalidatecache()
@@ -68,4 +222,6 @@ class SinogramStack(StackImage):
         """
         Override method from base class to read along sinogram dimension
         """
+        if getattr(self, 'sinograms', None) is not None:
+            return self.sinograms[frame].transpose()
         return self.fabimage[:, frame, :].transpose()
\ No newline at end of file
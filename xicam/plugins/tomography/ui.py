@@ -18,6 +18,7 @@ import pyqtgraph as pg
 from pyqtgraph import parametertree as pt
 import reconpkg
 import viewers
+import loader
 
 
 class UIform(object):
@@ -83,6 +84,14 @@ class UIform(object):
         icon.addPixmap(QtGui.QPixmap("xicam/gui/icons_56.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
         self.refreshaction = QtGui.QAction(icon, 'Reset', filefuncmenu)
         filefuncmenu.addActions([self.openaction, self.saveaction, self.refreshaction])
+        filefuncmenu.addSeparator()
+        self.sinogramcacheaction = QtGui.QAction('Cache sinograms of opened datasets', filefuncmenu)
+        self.sinogramcacheaction.setToolTip('Writes a sinogram-major copy of each dataset, as large as the data, next to '
+                                            'it (or in the user cache) for fast sinogram access')
+        self.sinogramcacheaction.setCheckable(True)
+        self.sinogramcacheaction.setChecked(loader.sinogramcachingenabled())
+        self.sinogramcacheaction.toggled.connect(loader.setsinogramcaching)
+        filefuncmenu.addAction(self.sinogramcacheaction)
 
         self.functionwidget.fileButton.setMenu(filefuncmenu)
         self.functionwidget.fileButton.setPopupMode(QtGui.QToolButton.ToolButtonPopupMode.InstantPopup)
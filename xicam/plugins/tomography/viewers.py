@@ -4,9 +4,11 @@ import tomopy
 import pyqtgraph as pg
 from PySide import QtGui, QtCore
 from collections import OrderedDict
+import loader
 from loader import ProjectionStack, SinogramStack
 from pipeline.loader import StackImage
 from pipeline import msg
+from xicam import threads
 from xicam.plugins.tomography import functionwidgets, reconpkg, config
 from xicam.widgets.customwidgets import DataTreeWidget, ImageView, dataDialog
 from xicam.widgets.roiwidgets import ROImageOverlay
@@ -151,6 +153,16 @@ class TomoViewer(QtGui.QWidget):
         self.viewmode.currentChanged.connect(self.viewstack.setCurrentIndex)
         self.viewstack.currentChanged.connect(self.viewmode.setCurrentIndex)
 
+        # Rechunk the projections into a sinogram-major cache in the background
+        if loader.sinogramcachingenabled() and isinstance(self.data, ProjectionStack) and self.data.sinograms is None \
+                and hasattr(self.data.fabimage, 'readstack'):
+            threads.method(callback_slot=self.sinogramcachebuilt)(self.data.cachesinograms)()
+
+    def sinogramcachebuilt(self, sinograms):
+        if sinograms is not False and sinograms is not None:
+            self.sinogramViewer.data.sinograms = sinograms
+            msg.showMessage('Sinogram cache ready', 4)
+
     def wireupCenterSelection(self, recon_function):
         """
         Connect the reconstruction functions parameters to the manual center selection button.
@@ -217,7 +229,8 @@ class TomoViewer(QtGui.QWidget):
         if slc is None:
             return np.ascontiguousarray(self.sinogramViewer.currentdata[:,np.newaxis,:])
         else:
-            return np.ascontiguousarray(self.data.fabimage[slc])
+            return np.ascontiguousarray(self.data.readstack(slc) if hasattr(self.data, 'readstack')
+                                        else self.data.fabimage[slc])
 
     def getproj(self, slc=None):
         """
@@ -8,6 +8,7 @@ from pipeline import loader, cosmics, integration, peakfinding, center_approx, v
 from xicam import config, ROI, debugtools, toolbar
 from fabio import edfimage
 import os
+import sys
 import pyqtgraph.parametertree.parameterTypes as pTypes
 from pyqtgraph.parametertree import Parameter, ParameterTree, ParameterItem, registerParameterType
 from xicam import dialogs
@@ -75,6 +76,8 @@ class OOMTabItem(QtGui.QWidget):
         if self.isloaded:
             if hasattr(self.widget,'save'):
                 self.saved = self.widget.save()
+            if hasattr(self.widget,'release'):
+                self.widget.release()
 
             self.widget.deleteLater()
             self.widget = None
@@ -974,6 +977,11 @@ class timelineViewer(dimgViewer):
 
         self.imgview.setImage(simg, xvals=simg.xvals(''))
 
+        # Read upcoming frames in the background while the user scrubs the timeline
+        self.readahead = loader.readahead(simg) if hasattr(simg, 'rawframekey') else None
+        if self.readahead is not None:
+            self.imgview.sigTimeChanged.connect(self.prefetch)
+
         # self.imageitem.sigImageChanged.connect(self.setscale)
 
         # self.paths = dict(zip(range(len(paths)), sorted(paths)))
@@ -1013,6 +1021,12 @@ class timelineViewer(dimgViewer):
         opwidgetaction.setDefaultWidget(operationcombo)
         # need to connect it
         menu.addAction(opwidgetaction)
+        if sys.platform not in ('win32', 'darwin'):
+            parallelaction = QtGui.QAction('Evaluate long timelines in worker processes', menu)
+            parallelaction.setCheckable(True)
+            parallelaction.setChecked(variation.parallelvariationenabled())
+            parallelaction.toggled.connect(variation.setparallelvariation)
+            menu.addAction(parallelaction)
 
         # self.imgview.getHistogramWidget().item.setImageItem(self.highresimgitem)
         # self.imgview.getHistogramWidget().item.sigLevelChangeFinished.connect(self.updatelowresLUT)
@@ -1031,6 +1045,15 @@ class timelineViewer(dimgViewer):
         self.timeline = timelineplot.getPlotItem()
         self.timeline.getViewBox().setMouseEnabled(x=False, y=True)
 
+    def prefetch(self, index, time):
+        self.readahead.update(index)
+
+    def release(self):
+        # The tab is being unloaded; drop its queued read-ahead so the shared pool doesn't read for a closed timeline
+        if self.readahead is not None:
+            self.imgview.sigTimeChanged.disconnect(self.prefetch)
+            self.readahead.cancel()
+
     def processtimeline(self):
         self.toolbar.actionProcess.setChecked(False)
         self.rescan()
@@ -1061,31 +1084,23 @@ class timelineViewer(dimgViewer):
         # d = dict(zip(keys,values))
         # self.plotvariation(d)
 
-        # Run on thread queue
-        bg_variation = threads.iterator(callback_slot=self.sigAddTimelineData,
-                                        finished_slot=self.processingfinished,
-                                        parent=self)(variation.variationiterator)
-        bg_variation(self.simg, self.operationindex)
-        # xglobals.pool.apply_async(variation.scanvariation,args=(self.simg.filepaths),callback=self.testreceive)
-
-        # variation = self.simg.scan(self.operationindex)
-        # self.plotvariation(variation)
-
+        # The full frame plus every live ROI, evaluated together in one pass over the series
+        rois = [None]
+        colors = [None]
         for roi in self.viewbox.addedItems:
-            # try:
             if hasattr(roi, 'isdeleting'):
                 if not roi.isdeleting:
-                    roi = roi.getArrayRegion(np.ones_like(self.imgview.imageItem.image), self.imageitem).T
-                    # variation = self.simg.scan(self.operationindex, roi)
-                    # self.plotvariation(variation, [0, 255, 255])
-                    # Run on thread queue
+                    rois.append(roi.getArrayRegion(np.ones_like(self.imgview.imageItem.image), self.imageitem).T)
                     # TODO: pull color from ROI, give ROIs deterministic colors with pyqtgraph.intColor
-                    bg_variation(self.simg, self.operationindex, roi=roi, color=[0, 255, 255])
+                    colors.append([0, 255, 255])
                 else:
                     self.viewbox.removeItem(roi)
-                    # except Exception as ex:
-                    # print 'Warning: error displaying ROI variation.'
-                    #    print ex.message
+
+        # Run on thread queue
+        bg_variation = threads.iterator(callback_slot=self.sigAddTimelineData,
+                                        finished_slot=self.processingfinished,
+                                        parent=self)(variation.variationiterator)
+        bg_variation(self.simg, self.operationindex, rois=rois, colors=colors)
 
 
     def processingfinished(self, *args, **kwargs):
@@ -1216,6 +1231,7 @@ class integrationsubwidget(pg.PlotWidget):
     integrationfunction = None
     iscake = False
     isremesh = False
+    isdetector = False  # integrates the untransformed detector image; rois are mapped back from the remeshed view
 
     def __init__(self,axislabel):
         super(integrationsubwidget, self).__init__()
@@ -1229,8 +1245,12 @@ class integrationsubwidget(pg.PlotWidget):
 
 
     def replot(self, dimg, rois, imageitem):
-        data = dimg.transformdata
-        mask = dimg.transformmask
+        if self.isdetector:
+            data = dimg.rawdata
+            mask = dimg.mask
+        else:
+            data = dimg.transformdata
+            mask = dimg.transformmask
         if self.integrationfunction is None:
             raise NotImplementedError
         try:
@@ -1238,8 +1258,9 @@ class integrationsubwidget(pg.PlotWidget):
         except ValueError:
             msg.logMessage('Maybe the roi was too far away?',msg.DEBUG)
 
-    def replotcallback(self,*args,**kwargs):
-        self.sigPlotResult.emit(*args, **kwargs)
+    def replotcallback(self, results):
+        for result in results:
+            self.sigPlotResult.emit(result)
 
     def applyintegration(self,integrationfunction,dimg,rois,data,mask,imageitem):
         self.requestkey += 1
@@ -1259,11 +1280,9 @@ class integrationsubwidget(pg.PlotWidget):
         #                                                                None, self.requestkey, qvrt, qpar),
         #                           callback=self.replotcallback)
 
-        runnable = threads.RunnableMethod(integrationfunction, method_args=(
-        data, mask, dimg.experiment.getAI().getPyFAI(), None, None, self.requestkey, qvrt, qpar),
-                                          callback_slot=self.replotcallback)
-        threads.add_to_queue(runnable)
-        # replot roi integration
+        # collect roi cuts so the full image and all rois are integrated as one job
+        cuts = []
+        colors = []
         for roi in rois:
             if roi.isdeleting:
                 roi.deleteLater()
@@ -1273,13 +1292,15 @@ class integrationsubwidget(pg.PlotWidget):
             msg.logMessage(('Cut:', cut.shape),msg.DEBUG)
 
             if cut is not None:
-                # xglobals.pool.apply_async(integrationfunction,
-                #                           args=(data, mask, dimg.experiment.getAI().getPyFAI(), cut, [0, 255, 255], self.requestkey, qvrt, qpar),
-                #                           callback=self.replotcallback)
-                runnable = threads.RunnableMethod(integrationfunction, method_args=(
-                data, mask, dimg.experiment.getAI().getPyFAI(), cut, [0, 255, 255], self.requestkey, qvrt, qpar),
-                                                  callback_slot=self.replotcallback)
-                threads.add_to_queue(runnable)
+                if self.isdetector: cut = dimg.detectorcut(cut)
+                cuts.append(cut)
+                colors.append([0, 255, 255])
+
+        runnable = threads.RunnableMethod(integration.integraterois, method_args=(
+        integrationfunction, data, mask, dimg.experiment.getAI().getPyFAI(), cuts, colors, self.requestkey, qvrt, qpar),
+                                          callback_slot=self.replotcallback)
+        threads.add_to_queue(runnable)
+
     def movPosLine(self, q,qx,qz,dimg=None):
         pass #raise NotImplementedError
 
@@ -1384,8 +1405,9 @@ class cakezintegrationwidget(integrationsubwidget):
 class remeshqintegrationwidget(integrationsubwidget):
 
     isremesh=True
+    isdetector = True
     sigPlotResult = QtCore.Signal(object)
-    integrationfunction = staticmethod(integration.remeshqintegrate)
+    integrationfunction = staticmethod(integration.gixsqintegrate)
 
     def __init__(self):
         super(remeshqintegrationwidget, self).__init__(axislabel=u'q (\u212B\u207B\u00B9)')
@@ -1398,8 +1420,9 @@ class remeshqintegrationwidget(integrationsubwidget):
 class remeshchiintegrationwidget(integrationsubwidget):
 
     isremesh=True
+    isdetector = True
     sigPlotResult = QtCore.Signal(object)
-    integrationfunction = staticmethod(integration.remeshchiintegrate)
+    integrationfunction = staticmethod(integration.gixschiintegrate)
 
     def __init__(self):
         super(remeshchiintegrationwidget, self).__init__(axislabel=u'χ (Degrees)')